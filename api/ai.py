@@ -1,129 +1,305 @@
 # api/ai.py
-import os, time
-from typing import List, Dict
-from fastapi import APIRouter
-from pydantic import BaseModel
-from google.cloud import bigquery
+import asyncio, json, os, time
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, List, Dict, Optional, Tuple
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from google.api_core.exceptions import GoogleAPICallError, BadRequest
 
-PROJECT_ID = os.environ.get("GOOGLE_CLOUD_PROJECT")
-LOCATION   = os.environ.get("VERTEX_LOCATION", "us-central1")
-DATASET    = os.environ.get("BQ_DATASET", "cookie_factory_mqtt")
-TABLE      = os.environ.get("BQ_TABLE",   "telemetry")
+from api import bq, metrics
+from api.bq import ClientDisconnected, QueryTimeout
+from api.context import build_context, estimate_tokens, history_block
+from api.queries import QueryTooExpensive
+from api.storage import Storage, get_storage
 
-# Keep your Vertex bits if you need them later
-from vertexai import init as vertex_init
-from vertexai.generative_models import GenerativeModel, Part
-MODEL_NAME = os.environ.get("VERTEX_MODEL", "gemini-1.5-flash-002")
+from vertexai.generative_models import Part
+
+from api.vertex import VertexModel, get_vertex
+
+GENERATION_CONFIG = {"temperature": 0.3, "max_output_tokens": 512}
+# Add per-machine window totals (kWh, CO₂, avg power, max scrap) to the context
+CONTEXT_AGGREGATES = os.environ.get("CONTEXT_AGGREGATES", "true").lower() in ("1", "true", "yes", "on")
+# A UI snapshot younger than this is used as-is instead of querying storage
+SNAPSHOT_MAX_AGE_S = float(os.environ.get("CHAT_SNAPSHOT_MAX_AGE_S", "120"))
+# Per-stage deadlines (seconds) for the chat pipeline
+STAGE_DEADLINES = {
+    "latest":     float(os.environ.get("CHAT_LATEST_TIMEOUT_S", "15")),
+    "aggregates": float(os.environ.get("CHAT_AGGREGATES_TIMEOUT_S", "5")),
+    "model":      float(os.environ.get("CHAT_MODEL_TIMEOUT_S", "20")),
+    "generate":   float(os.environ.get("CHAT_GENERATE_TIMEOUT_S", "60")),
+}
 
 router = APIRouter(prefix="/api/ai", tags=["ai"])
 
+class MachineRow(BaseModel):
+    """One /api/machines/latest item as the client echoes it back."""
+    machine_id: str
+    name: Optional[str] = None
+    type: Optional[str] = None
+    ts: datetime
+    power_w: Optional[float] = None
+    co2_kg_per_min: Optional[float] = None
+    scrap_rate_pct: Optional[float] = None
+
+class ChatContext(BaseModel):
+    # Validated row by row in _fresh_snapshot so one bad row doesn't reject the request
+    machines: List[Dict] = Field(default_factory=list)  # rows shaped like MachineRow
+    workers: List[Dict] = Field(default_factory=list)
+    as_of: Optional[datetime] = None  # when the client fetched `machines`
+
+class ChatTurn(BaseModel):
+    role: str = "user"
+    content: str = ""
+
 class ChatIn(BaseModel):
     prompt: str
     minutes: int = 15  # how much telemetry to consider
+    stream: bool = False  # answer as server-sent events (delta chunks + final envelope)
+    context: Optional[ChatContext] = None
+    history: List[ChatTurn] = Field(default_factory=list)
 
-def _resolve_co2_column(client: bigquery.Client) -> str:
-    """
-    Look up which CO₂ column exists in the table: 'co_2_kg_per_min' (current) or
-    the older 'co2_kg_per_min'. Default to 'co_2_kg_per_min' if both present or neither found.
-    """
-    sql = f"""
-    SELECT column_name
-    FROM `{PROJECT_ID}.{DATASET}.INFORMATION_SCHEMA.COLUMNS`
-    WHERE table_name=@table
-      AND column_name IN ('co_2_kg_per_min', 'co2_kg_per_min')
-    ORDER BY CASE column_name
-               WHEN 'co_2_kg_per_min' THEN 0  -- prefer the canonical name
-               ELSE 1
-             END
-    LIMIT 1
+def _fresh_snapshot(ctx: Optional[ChatContext]) -> Optional[List[Dict]]:
+    """The client's machines if they were fetched recently enough to answer from."""
+    if ctx is None or not ctx.machines or ctx.as_of is None:
+        return None
+    as_of = ctx.as_of if ctx.as_of.tzinfo else ctx.as_of.replace(tzinfo=timezone.utc)
+    age = (datetime.now(timezone.utc) - as_of).total_seconds()
+    if age > SNAPSHOT_MAX_AGE_S or age < -60:  # stale, or a clock we can't trust
+        return None
+    rows = []
+    for m in ctx.machines:
+        try:
+            rows.append(MachineRow.model_validate(m).model_dump())
+        except ValidationError:
+            metrics.incr("ai.context.snapshot_bad_rows")
+    return rows or None  # nothing usable: fetch from storage instead
+
+class StageTimeout(Exception):
+    def __init__(self, stage: str, timeout_s: float):
+        super().__init__(f"{stage} stage exceeded {timeout_s:g}s")
+        self.stage = stage
+
+class _Timings(dict):
+    """stage -> milliseconds; also fed to api.metrics as ai.chat.<stage>."""
+
+    async def run(self, stage: str, aw: Awaitable):
+        """Await one pipeline stage under its STAGE_DEADLINES entry."""
+        timeout_s = STAGE_DEADLINES[stage]
+        t0 = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout_s):
+                return await aw
+        except TimeoutError as e:
+            raise StageTimeout(stage, timeout_s) from e
+        finally:
+            self.mark(stage, t0)
+
+    def mark(self, stage: str, t0: float) -> None:
+        ms = (time.perf_counter() - t0) * 1000
+        self[stage] = round(ms, 1)
+        metrics.observe(f"ai.chat.{stage}", ms)
+
+    def header(self) -> str:
+        """Server-Timing value, e.g. `latest;dur=84.2, model;dur=0.1`."""
+        return ", ".join(f"{k};dur={v}" for k, v in self.items())
+
+async def _optional_aggregates(timings: _Timings, storage: Storage, minutes: int) -> Dict[str, Dict]:
+    """Window totals are optional context; on failure or timeout the table just leaves them out."""
+    if not CONTEXT_AGGREGATES:
+        return {}
+    try:
+        return await timings.run("aggregates", storage.aggregates(minutes))
+    except (GoogleAPICallError, QueryTimeout, QueryTooExpensive, StageTimeout) as e:
+        metrics.incr("ai.context.aggregates_failed")
+        print(f"[ai] window aggregates unavailable: {e}", flush=True)
+        return {}
+
+async def _prepare(req: ChatIn, storage: Optional[Storage], timings: _Timings) -> Tuple[List[Dict], str]:
     """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("table", "STRING", TABLE)]
-        ),
-    )
-    rows = list(job)
-    if rows:
-        return rows[0]["column_name"]
-    # Fallback to canonical name
-    return "co_2_kg_per_min"
-
-def _fetch_latest(minutes: int) -> List[Dict]:
-    assert PROJECT_ID, "GOOGLE_CLOUD_PROJECT not set"
-    client = bigquery.Client(project=PROJECT_ID)
-
-    co2_col = _resolve_co2_column(client)  # 'co_2_kg_per_min' or 'co2_kg_per_min'
-
-    sql = f"""
-    SELECT
-      machine_id,
-      name,
-      type,
-      TIMESTAMP_MILLIS(CAST(ts*1000 AS INT64)) AS ts,
-      power_w,
-      `{co2_col}` AS co2_kg_per_min,
-      scrap_rate_pct
-    FROM `{PROJECT_ID}.{DATASET}.{TABLE}`
-    WHERE TIMESTAMP_MILLIS(CAST(ts*1000 AS INT64)) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @mins MINUTE)
-    QUALIFY ROW_NUMBER() OVER (PARTITION BY machine_id ORDER BY ts DESC) = 1
-    ORDER BY machine_id
+    Telemetry (latest + window aggregates in parallel, or the client's fresh
+    snapshot) and history compaction -> (rows, user prompt). Runs while the
+    model handle is being set up.
     """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("mins", "INT64", minutes)]
-        ),
+    snapshot = _fresh_snapshot(req.context)
+    tasks: List[asyncio.Future] = []
+    if snapshot:
+        # Follow-ups answer from what the user is looking at: no warehouse trip
+        metrics.incr("ai.context.snapshot")
+    else:
+        metrics.incr("ai.context.fetched")
+        assert storage is not None, "GOOGLE_CLOUD_PROJECT not set"
+        tasks = [
+            asyncio.ensure_future(timings.run(
+                "latest", storage.latest(req.minutes, route="chat", endpoint="ai.latest")
+            )),
+            asyncio.ensure_future(_optional_aggregates(timings, storage, req.minutes)),
+        ]
+    try:
+        t0 = time.perf_counter()
+        turns = [t.model_dump() for t in req.history]
+        if turns and turns[-1]["role"] == "user" and turns[-1]["content"].strip() == req.prompt.strip():
+            turns.pop()  # the UI's history already ends with this prompt
+        conversation = history_block(turns)
+        timings.mark("history", t0)
+
+        if snapshot:
+            rows, aggregates = snapshot, {}
+        else:
+            rows, aggregates = await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            if not t.done():
+                t.cancel()
+
+    t0 = time.perf_counter()
+    # Ranked, rounded, token-budgeted table instead of a dict repr
+    context = build_context(rows, aggregates, window_min=req.minutes)
+    timings.mark("context", t0)
+    metrics.incr("ai.context.tokens", estimate_tokens(context))
+    user = (
+        (f"Conversation so far:\n{conversation}\n\n" if conversation else "")
+        + f"{req.prompt}\n\n"
+        f"Latest telemetry:\n"
+        f"{context}\n\n"
+        "Answer using the telemetry above."
     )
-    return [dict(row) for row in job]
+    return rows, user
 
 def _system_prompt() -> str:
     return (
         "You are the Cookie Factory Copilot. "
         "Analyze the latest machine telemetry and answer briefly with clear, actionable bullets. "
-        "If data is missing, say so. Mention machine names and timestamps with metrics. "
-        "If scrap_rate_pct > 1.0, flag an alert."
+        "If data is missing, say so. Mention machine names and reading ages with metrics. "
+        "Telemetry is a pipe-separated table; rows flagged ALERT are over the scrap limit, "
+        "STALE rows have not reported recently."
     )
 
 @router.post("/chat")
-def chat(req: ChatIn):
+async def chat(
+    req: ChatIn,
+    request: Request,
+    storage: Optional[Storage] = Depends(get_storage),
+    vertex: VertexModel = Depends(get_vertex),
+):
+    """
+    Pipeline: model setup overlaps the telemetry fetch (latest and aggregates
+    in parallel) and history compaction; each stage has its own deadline
+    (STAGE_DEADLINES), a client disconnect cancels whatever is still running,
+    and per-stage timings come back in a Server-Timing header.
+    """
+    timings = _Timings()
+    # Shielded: a cancelled request must not abort a cold start other requests wait on.
+    model_task = asyncio.ensure_future(timings.run("model", asyncio.shield(vertex.get())))
+
+    def envelope(error: str, output: str = "", machine_count: int = 0) -> JSONResponse:
+        return JSONResponse(
+            {"error": error, "output": output, "machine_count": machine_count},
+            headers={"Server-Timing": timings.header()},
+        )
+
     try:
-        rows = _fetch_latest(req.minutes)
-    except BadRequest as e:
-        # Return a JSON error the UI can render cleanly
-        return {"error": f"BigQuery error: {e}", "output": "", "machine_count": 0}
-    except GoogleAPICallError as e:
-        return {"error": f"BigQuery call failed: {e}", "output": "", "machine_count": 0}
-
-    # Construct a compact context JSON block
-    context = {
-        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-        "machines": rows,
-    }
+        rows, user = await bq.cancel_on_disconnect(request, _prepare(req, storage, timings))
+    except BaseException as e:
+        model_task.cancel()
+        if isinstance(e, ClientDisconnected):
+            return envelope("client disconnected")
+        if isinstance(e, StageTimeout):
+            return envelope(f"Telemetry timeout: {e}")
+        if isinstance(e, QueryTimeout):
+            return envelope(f"BigQuery timeout: {e}")
+        if isinstance(e, QueryTooExpensive):
+            return envelope(f"BigQuery cost guard: {e}")
+        if isinstance(e, BadRequest):
+            # Return a JSON error the UI can render cleanly
+            return envelope(f"BigQuery error: {e}")
+        if isinstance(e, GoogleAPICallError):
+            return envelope(f"BigQuery call failed: {e}")
+        raise
+
+    if req.stream:
+        return StreamingResponse(
+            _stream_answer(vertex, model_task, user, len(rows), timings),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+                "Server-Timing": timings.header(),  # stages before the first token
+            },
+        )
 
     # Call Vertex (non-streaming)
     try:
-        vertex_init(project=PROJECT_ID, location=LOCATION)
-        model = GenerativeModel(MODEL_NAME)
-        user = (
-            f"{req.prompt}\n\n"
-            f"Here is the latest telemetry JSON:\n"
-            f"{context}\n\n"
-            "Answer using the telemetry above."
+        model = await model_task
+        text = await bq.cancel_on_disconnect(
+            request, timings.run("generate", _generate(vertex, model, user))
         )
-        resp = model.generate_content(
-            [Part.from_text(_system_prompt()), Part.from_text(user)],
-            safety_settings=None,
-            generation_config={"temperature": 0.3, "max_output_tokens": 512},
-        )
-        text = getattr(resp, "text", None) or "(no response)"
+    except ClientDisconnected:
+        return envelope("client disconnected", machine_count=len(rows))
     except Exception as e:
         # Return an error string but still a valid JSON body
-        return {
-            "error": f"Vertex error: {e}",
-            "output": "",
-            "machine_count": len(rows),
-        }
+        return envelope(f"Vertex error: {e}", machine_count=len(rows))
+
+    return envelope("", text, len(rows))
 
-    return {"error": "", "output": text, "machine_count": len(rows)}
+def _contents(user: str) -> List:
+    return [Part.from_text(_system_prompt()), Part.from_text(user)]
+
+async def _generate(vertex: VertexModel, model, user: str) -> str:
+    async with vertex.slot():
+        resp = await model.generate_content_async(
+            _contents(user),
+            safety_settings=None,
+            generation_config=GENERATION_CONFIG,
+        )
+    return getattr(resp, "text", None) or "(no response)"
+
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+async def _stream_answer(
+    vertex: VertexModel, model_task: asyncio.Future, user: str, machine_count: int, timings: _Timings
+) -> AsyncIterator[str]:
+    """
+    SSE body for stream=true: one `delta` event per Vertex chunk as it
+    arrives, then a `done` event carrying the usual envelope (error/output/
+    machine_count) plus the full per-stage timings. The generate deadline
+    covers the whole stream; a disconnect cancels this generator mid-stream.
+    """
+    parts: List[str] = []
+    error = ""
+    try:
+        model = await model_task
+        t0 = time.perf_counter()
+        async with vertex.slot():
+            async with asyncio.timeout(STAGE_DEADLINES["generate"]):
+                chunks = await model.generate_content_async(
+                    _contents(user),
+                    safety_settings=None,
+                    generation_config=GENERATION_CONFIG,
+                    stream=True,
+                )
+                async for chunk in chunks:
+                    try:
+                        text = chunk.text
+                    except (ValueError, AttributeError):  # safety-blocked or empty candidate
+                        continue
+                    if text:
+                        if not parts:
+                            timings.mark("first_token", t0)
+                        parts.append(text)
+                        yield _sse("delta", {"text": text})
+        timings.mark("generate", t0)
+    except TimeoutError:
+        error = f"Vertex error: generate stage exceeded {STAGE_DEADLINES['generate']:g}s"
+    except Exception as e:
+        error = f"Vertex error: {e}"
+    finally:
+        model_task.cancel()  # no-op once done
+    output = "".join(parts)
+    if not output and not error:
+        output = "(no response)"
+        yield _sse("delta", {"text": output})
+    yield _sse("done", {
+        "error": error, "output": output, "machine_count": machine_count, "timings": dict(timings),
+    })
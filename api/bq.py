@@ -0,0 +1,124 @@
+# api/bq.py
+import asyncio, functools, os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import Request
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
+POOL_SIZE  = int(os.getenv("BQ_HTTP_POOL_SIZE", "32"))
+
+# Per-route limits; ROUTE_LIMITS entries override the defaults.
+DEFAULT_CONCURRENCY = int(os.getenv("BQ_MAX_CONCURRENCY", "4"))
+DEFAULT_TIMEOUT_S   = float(os.getenv("BQ_TIMEOUT_S", "20"))
+ROUTE_LIMITS: Dict[str, Dict[str, float]] = {
+    "latest":  {"concurrency": DEFAULT_CONCURRENCY, "timeout_s": DEFAULT_TIMEOUT_S},
+    "history": {"concurrency": int(os.getenv("BQ_HISTORY_CONCURRENCY", "2")),
+                "timeout_s": float(os.getenv("BQ_HISTORY_TIMEOUT_S", "60"))},
+    "chat":    {"concurrency": DEFAULT_CONCURRENCY, "timeout_s": DEFAULT_TIMEOUT_S},
+}
+
+# Blocking client calls (job insert, status polls, result pages) run on this
+# small dedicated pool, never on Starlette's threadpool that also serves the
+# WSGI-mounted Mesop UI. Each call is short; waiting for a job is an await.
+_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BQ_THREADS", "8")), thread_name_prefix="bq"
+)
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+class QueryTimeout(Exception):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+def create_client() -> Optional[bigquery.Client]:
+    """
+    Build the process-wide BigQuery client (called once from the app lifespan).
+    Credentials are loaded once and every request reuses the same pooled,
+    keep-alive HTTP session instead of paying auth + TLS setup per call.
+    """
+    if not PROJECT_ID:
+        return None
+    client = bigquery.Client(project=PROJECT_ID)
+    # Default urllib3 pool keeps 10 connections; size it for concurrent handlers.
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    client._http.mount("https://", adapter)
+    return client
+
+def create_bqstorage_client():
+    """
+    BigQuery Storage Read API client for streaming large results as Arrow.
+    google-cloud-bigquery[bqstorage] is a project dependency; None if unconfigured
+    or the extra is missing from a hand-built environment.
+    """
+    if not PROJECT_ID:
+        return None
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        return None
+    return bigquery_storage.BigQueryReadClient()
+
+# ---- async execution ----
+async def call(fn: Callable, *args, **kwargs) -> Any:
+    """Run one blocking client call on the BigQuery pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+@asynccontextmanager
+async def guard(route: str):
+    """Per-route concurrency slot + deadline; TimeoutError becomes QueryTimeout."""
+    limits = ROUTE_LIMITS.get(route, {})
+    sem = _semaphores.get(route)
+    if sem is None:
+        sem = _semaphores[route] = asyncio.Semaphore(int(limits.get("concurrency", DEFAULT_CONCURRENCY)))
+    timeout_s = limits.get("timeout_s", DEFAULT_TIMEOUT_S)
+    try:
+        async with asyncio.timeout(timeout_s):
+            async with sem:
+                yield
+    except TimeoutError as e:
+        raise QueryTimeout(f"{route} query exceeded {timeout_s:g}s") from e
+
+async def submit_and_wait(
+    client: bigquery.Client, sql: str, job_config: Optional[bigquery.QueryJobConfig] = None
+) -> bigquery.QueryJob:
+    """
+    Start a query job and await completion without holding a thread.
+    If the awaiting task is cancelled (deadline, client gone) the job is cancelled too.
+    """
+    job = await call(client.query, sql, job_config=job_config)
+    delay = 0.05
+    try:
+        while not await call(job.done):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+    except BaseException:
+        _EXECUTOR.submit(_cancel_quietly, job)
+        raise
+    return job
+
+def _cancel_quietly(job: bigquery.QueryJob) -> None:
+    try:
+        job.cancel()
+    except Exception:
+        pass
+
+async def cancel_on_disconnect(request: Request, work: Awaitable, poll_s: float = 0.5) -> Any:
+    """Await `work`, cancelling it (and any BigQuery job under it) if the client disconnects."""
+    task = asyncio.ensure_future(work)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_s)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
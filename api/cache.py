@@ -0,0 +1,68 @@
+# api/cache.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+from api import metrics
+
+class TTLCache:
+    """
+    Small in-process result cache with single-flight loading.
+
+    Entries live for `ttl_s` seconds and at most `max_entries` are kept (LRU).
+    Concurrent misses on the same key share one loader task: the first caller
+    starts it, everyone awaits it (shielded). The shared load is only
+    cancelled when every waiter has gone away. Errors are never cached.
+    Hits/misses/coalesced waits are counted in api.metrics as cache.<name>.*.
+    """
+
+    def __init__(self, name: str, ttl_s: float, max_entries: int = 64):
+        self.name = name
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        # key -> [loader task, number of waiters]
+        self._inflight: Dict[Hashable, List] = {}
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._data.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._data.move_to_end(key)
+            metrics.incr(f"cache.{self.name}.hit")
+            return entry[1]
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = self._inflight[key] = [asyncio.ensure_future(self._load(key, loader)), 0]
+            metrics.incr(f"cache.{self.name}.miss")
+        else:
+            metrics.incr(f"cache.{self.name}.coalesced")
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not task.done():
+                task.cancel()
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """Drop one entry (or everything); the next get_or_load reloads it."""
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await loader()
+        finally:
+            self._inflight.pop(key, None)
+        if self.ttl_s > 0:
+            self._data[key] = (time.monotonic() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return value
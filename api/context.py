@@ -0,0 +1,163 @@
+# api/context.py
+"""
+Compact telemetry context for the copilot prompt.
+
+Instead of str() of a dict of rows (datetime reprs, full float precision and
+the same keys repeated per machine), the builder emits one legend line and a
+pipe-separated table: values rounded to what matters on the floor, reading
+age instead of absolute timestamps, and the scrap-rate margin against the
+alert threshold as a signed delta. Machines are ranked so alerts and stale
+readings come first, and rows are added until CONTEXT_TOKEN_BUDGET is
+reached; whatever doesn't fit is summarised in one line.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+TOKEN_BUDGET     = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+SCRAP_ALERT_PCT  = float(os.getenv("SCRAP_ALERT_PCT", "1.0"))
+STALE_AFTER_S    = float(os.getenv("CONTEXT_STALE_AFTER_S", "120"))
+CHARS_PER_TOKEN  = 4  # rough Gemini/English average; good enough for budgeting
+
+COLUMNS = ("machine", "type", "age_s", "power_w", "co2_kg_min", "scrap_pct", "scrap_vs_limit", "flag")
+AGG_COLUMNS = ("avg_power_w", "max_scrap_pct", "kwh", "co2_kg")
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _num(v: Optional[float], digits: int) -> str:
+    if v is None:
+        return "-"
+    s = f"{v:.{digits}f}"
+    return s.rstrip("0").rstrip(".") if "." in s else s
+
+def _sig(v: Optional[float], digits: int = 3) -> str:
+    """Significant figures, for small rates (CO₂ ~0.0005 kg/min) that fixed decimals flatten."""
+    return "-" if v is None else f"{v:.{digits}g}"
+
+def _age_s(ts, now: datetime) -> Optional[float]:
+    if ts is None:
+        return None
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - ts).total_seconds())
+
+def _rank(row: Dict, age: Optional[float]) -> Tuple:
+    scrap = row.get("scrap_rate_pct")
+    over = (scrap - SCRAP_ALERT_PCT) if scrap is not None else float("-inf")
+    stale = age is None or age > STALE_AFTER_S
+    # alerts by margin, then stale readings, then the biggest consumers
+    return (over <= 0, not stale, -over, -(row.get("power_w") or 0.0))
+
+def _flag(row: Dict, age: Optional[float]) -> str:
+    flags = []
+    scrap = row.get("scrap_rate_pct")
+    if scrap is not None and scrap > SCRAP_ALERT_PCT:
+        flags.append("ALERT")
+    if age is None or age > STALE_AFTER_S:
+        flags.append("STALE")
+    return ",".join(flags) or "ok"
+
+def build_context(
+    rows: Sequence[Dict],
+    aggregates: Optional[Dict[str, Dict]] = None,
+    window_min: Optional[int] = None,
+    budget_tokens: int = TOKEN_BUDGET,
+    now: Optional[datetime] = None,
+) -> str:
+    """Rank, round and tabulate latest rows (+ optional window aggregates) within a token budget."""
+    now = now or datetime.now(timezone.utc)
+    aggregates = aggregates or {}
+    columns = COLUMNS + (AGG_COLUMNS if aggregates else ())
+
+    summary = f"as_of={now.strftime('%Y-%m-%dT%H:%M:%SZ')} machines={len(rows)}"
+    if window_min:
+        summary += f" window={window_min}m"
+    head = [
+        summary,
+        f"scrap limit {SCRAP_ALERT_PCT:g}% (scrap_vs_limit>0 = over); stale if age_s>{STALE_AFTER_S:g}",
+        "|".join(columns),
+    ]
+    if aggregates:
+        head.insert(2, "last 4 columns aggregate the whole window")
+
+    ranked: List[Tuple[Tuple, Dict, Optional[float]]] = []
+    for row in rows:
+        age = _age_s(row.get("ts"), now)
+        ranked.append((_rank(row, age), row, age))
+    ranked.sort(key=lambda r: r[0])
+
+    lines = list(head)
+    used = estimate_tokens("\n".join(lines))
+    omitted: List[Dict] = []
+    for _, row, age in ranked:
+        scrap = row.get("scrap_rate_pct")
+        cells = [
+            str(row.get("name") or row.get("machine_id")),
+            str(row.get("type") or "-"),
+            _num(age, 0),
+            _num(row.get("power_w"), 0),
+            _sig(row.get("co2_kg_per_min")),
+            _num(scrap, 2),
+            (f"{scrap - SCRAP_ALERT_PCT:+.2f}" if scrap is not None else "-"),
+            _flag(row, age),
+        ]
+        if aggregates:
+            agg = aggregates.get(row.get("machine_id"), {})
+            cells += [
+                _num(agg.get("avg_power_w"), 0),
+                _num(agg.get("max_scrap_rate_pct"), 2),
+                _sig(agg.get("kwh")),
+                _sig(agg.get("co2_kg")),
+            ]
+        line = "|".join(cells)
+        cost = estimate_tokens(line) + 1
+        if omitted or used + cost > budget_tokens:
+            omitted.append(row)
+            continue
+        lines.append(line)
+        used += cost
+
+    if omitted:
+        alerts = sum(1 for r in omitted if (r.get("scrap_rate_pct") or 0) > SCRAP_ALERT_PCT)
+        lines.append(f"+{len(omitted)} more machines omitted for length ({alerts} over scrap limit)")
+    return "\n".join(lines)
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "400"))
+HISTORY_KEEP_TURNS   = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "4"))
+TURN_MAX_CHARS       = 600   # recent turns, verbatim up to this
+GIST_MAX_CHARS       = 80    # older turns, first line only
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[: limit - 1] + "…"
+
+def history_block(turns: Sequence[Dict], budget_tokens: int = HISTORY_TOKEN_BUDGET) -> str:
+    """
+    Bounded conversation carry-over: the last HISTORY_KEEP_TURNS turns (clipped),
+    older ones reduced to a one-line gist each; oldest gists are dropped first
+    when over budget. Extractive, so it costs no extra model call.
+    """
+    turns = [t for t in turns if (t.get("content") or "").strip()]
+    if not turns:
+        return ""
+    recent = turns[-HISTORY_KEEP_TURNS:]
+    older = turns[:-HISTORY_KEEP_TURNS] if len(turns) > HISTORY_KEEP_TURNS else []
+
+    recent_lines = [f"{t.get('role', 'user')}: {_clip(t['content'], TURN_MAX_CHARS)}" for t in recent]
+    gist_lines = [
+        f"- {t.get('role', 'user')}: {_clip(t['content'].strip().splitlines()[0], GIST_MAX_CHARS)}"
+        for t in older
+    ]
+    while recent_lines and estimate_tokens("\n".join(gist_lines + recent_lines)) > budget_tokens:
+        if gist_lines:
+            gist_lines.pop(0)
+        else:
+            recent_lines.pop(0)
+    lines = []
+    if gist_lines:
+        lines += ["Earlier (gist):", *gist_lines]
+    lines += recent_lines
+    return "\n".join(lines)
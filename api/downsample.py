@@ -0,0 +1,83 @@
+# api/downsample.py
+"""
+Server-side downsampling of (t, v) series to a point budget.
+
+MinMaxBuckets works in one streaming pass over unordered input, so large
+pulls never need to be materialised. lttb() (Largest-Triangle-Three-Buckets)
+keeps visual shape better but needs the whole ordered series.
+"""
+from typing import List, Optional, Sequence, Tuple
+
+Point = Tuple[float, float]
+
+class MinMaxBuckets:
+    """Split [start, end) into points//2 equal buckets and keep each bucket's min and max."""
+
+    def __init__(self, start: float, end: float, points: int):
+        self.start = start
+        self.n = max(1, points // 2)
+        self.width = max(1e-9, (end - start) / self.n)
+        self._b: List[Optional[List[float]]] = [None] * self.n  # [min_t, min_v, max_t, max_v]
+        self.count = 0
+
+    def add(self, t: float, v: float) -> None:
+        i = int((t - self.start) / self.width)
+        if i < 0 or i >= self.n:
+            return
+        self.count += 1
+        b = self._b[i]
+        if b is None:
+            self._b[i] = [t, v, t, v]
+            return
+        if v < b[1]:
+            b[0], b[1] = t, v
+        if v > b[3]:
+            b[2], b[3] = t, v
+
+    def extend(self, ts: Sequence[float], vs: Sequence[float]) -> None:
+        for t, v in zip(ts, vs):
+            if v is not None:
+                self.add(t, v)
+
+    def result(self) -> List[Point]:
+        out: List[Point] = []
+        for b in self._b:
+            if b is None:
+                continue
+            lo, hi = (b[0], b[1]), (b[2], b[3])
+            if lo == hi:
+                out.append(lo)
+            else:
+                out.extend(sorted((lo, hi)))
+        return out
+
+def lttb(points: Sequence[Point], threshold: int) -> List[Point]:
+    """Largest-Triangle-Three-Buckets over time-ordered points."""
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(points)
+
+    out = [points[0]]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third triangle vertex
+        nxt_lo = int((i + 1) * every) + 1
+        nxt_hi = min(int((i + 2) * every) + 1, n)
+        span = max(1, nxt_hi - nxt_lo)
+        avg_t = sum(p[0] for p in points[nxt_lo:nxt_hi]) / span
+        avg_v = sum(p[1] for p in points[nxt_lo:nxt_hi]) / span
+
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        at, av = points[a]
+        best, best_area = lo, -1.0
+        for j in range(lo, hi):
+            t, v = points[j]
+            area = abs((at - avg_t) * (v - av) - (at - t) * (avg_v - av))
+            if area > best_area:
+                best, best_area = j, area
+        out.append(points[best])
+        a = best
+    out.append(points[-1])
+    return out
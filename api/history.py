@@ -0,0 +1,175 @@
+# api/history.py
+import os, re, time
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from google.cloud import bigquery
+
+from api import bq, metrics, queries, schema
+from api.downsample import MinMaxBuckets, lttb
+
+try:  # Arrow streaming (google-cloud-bigquery[bqstorage], a project dependency)
+    import pyarrow  # noqa: F401
+    HAVE_ARROW = True
+except ImportError:
+    HAVE_ARROW = False
+
+TABLE = os.getenv("BQ_TABLE", "telemetry")
+
+# Columns on the core table; anything else lives in the <table>_<type> sensor
+# table. Only used when the schema cache has no metadata for the dataset.
+CORE_FIELDS = {"power_w", "co_2_kg_per_min", "noise_db", "ambient_temp_c", "scrap_rate_pct"}
+# Identifier/label columns; never a plottable series (checked when there is no metadata).
+NON_METRIC_FIELDS = {"pk", "ts", "event_time", "machine_id", "name", "type", "batch_id"}
+FIELD_ALIASES = {"co2_kg_per_min": "co_2_kg_per_min"}
+_FIELD_RE = re.compile(r"^[a-z][a-z0-9_]{0,63}$")
+
+_machine_types: Dict[str, str] = {}  # machine_id -> type; machines don't change type
+
+class HistoryError(ValueError):
+    pass
+
+def _type_slug(machine_type: str) -> str:
+    # same rule as the connector's fan-out table names
+    return "".join(c if c.isalnum() else "_" for c in machine_type.strip().lower())
+
+async def _machine_type(client: bigquery.Client, machine_id: str, start: datetime, end: datetime) -> str:
+    mtype = _machine_types.get(machine_id)
+    if mtype:
+        return mtype
+    sql = f"""
+    SELECT type
+    FROM {queries.table_ref(TABLE)}
+    WHERE machine_id = @m AND {queries.range_predicate()}
+    LIMIT 1
+    """
+    job = await queries.submit(
+        client, sql, _range_params(machine_id, start, end), endpoint="machines.history.type"
+    )
+    rows = await bq.call(lambda: list(job.result()))
+    if not rows or not rows[0]["type"]:
+        raise HistoryError(f"no telemetry for machine {machine_id!r} in range")
+    _machine_types[machine_id] = rows[0]["type"]
+    return rows[0]["type"]
+
+async def _locate(
+    client: bigquery.Client, machine_id: str, field: str, start: datetime, end: datetime
+) -> Tuple[str, str]:
+    """(table, column) holding numeric `field`, spelled the way the table spells it."""
+    tables = await schema.columns(client)
+    core = tables.get(TABLE)
+    if core is not None:
+        column = schema.match(core, field)
+        if column:
+            return TABLE, _numeric(core, column, field)
+    elif FIELD_ALIASES.get(field, field) in CORE_FIELDS:
+        return TABLE, FIELD_ALIASES.get(field, field)
+    table = f"{TABLE}_{_type_slug(await _machine_type(client, machine_id, start, end))}"
+    sensors = tables.get(table)
+    if sensors is None:
+        if field in NON_METRIC_FIELDS:
+            raise HistoryError(f"field {field!r} is not numeric")
+        return table, field
+    column = schema.match(sensors, field)
+    if column is None:
+        raise HistoryError(f"unknown field {field!r} for machine {machine_id!r}")
+    return table, _numeric(sensors, column, field)
+
+def _numeric(columns: Dict[str, str], column: str, field: str) -> str:
+    if not schema.is_numeric(columns[column]):
+        raise HistoryError(f"field {field!r} is not numeric ({columns[column]})")
+    return column
+
+def _range_params(machine_id: str, start: datetime, end: datetime) -> List:
+    return [
+        bigquery.ScalarQueryParameter("m", "STRING", machine_id),
+        bigquery.ScalarQueryParameter("from", "TIMESTAMP", start),
+        bigquery.ScalarQueryParameter("to", "TIMESTAMP", end),
+    ]
+
+def _iter_batches(job: bigquery.QueryJob, bqstorage_client) -> Iterator[Tuple[List, List]]:
+    """
+    Stream (t, v) column chunks through the BigQuery Storage Read API (Arrow);
+    pages of the REST result only if pyarrow is missing from the environment.
+    """
+    result = job.result(page_size=50_000)
+    if HAVE_ARROW:
+        for batch in result.to_arrow_iterable(bqstorage_client=bqstorage_client):
+            yield batch.column("t").to_pylist(), batch.column("v").to_pylist()
+        return
+    for page in result.pages:
+        rows = list(page)
+        yield [r["t"] for r in rows], [r["v"] for r in rows]
+
+def reduce_batches(
+    batches: Iterable[Tuple[List, List]], start: datetime, end: datetime, points: int, method: str
+) -> Tuple[int, List[Tuple[float, float]]]:
+    """Blocking: stream (t_ms, v) column chunks through the downsampler -> (raw_count, points)."""
+    if method == "lttb":
+        series: List[Tuple[float, float]] = []
+        for ts, vs in batches:
+            series.extend(zip(ts, vs))
+        return len(series), lttb(series, points)
+    buckets = MinMaxBuckets(start.timestamp() * 1000, end.timestamp() * 1000, points)
+    for ts, vs in batches:
+        buckets.extend(ts, vs)
+    return buckets.count, buckets.result()
+
+def check_request(field: str, start: datetime, end: datetime) -> None:
+    if not _FIELD_RE.match(field):
+        raise HistoryError(f"invalid field {field!r}")
+    if end <= start:
+        raise HistoryError("'to' must be after 'from'")
+
+def history_payload(
+    machine_id: str, field: str, start: datetime, end: datetime, method: str,
+    raw_count: int, out: List[Tuple[float, float]],
+) -> Dict:
+    return {
+        "machine_id": machine_id,
+        "field": field,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "method": method,
+        "raw_count": raw_count,
+        "count": len(out),
+        "points": [[int(t), v] for t, v in out],
+    }
+
+async def fetch_history(
+    client: bigquery.Client,
+    bqstorage_client,
+    machine_id: str,
+    field: str,
+    start: datetime,
+    end: datetime,
+    points: int,
+    method: str = "minmax",
+) -> Dict:
+    check_request(field, start, end)
+
+    t0 = time.perf_counter()
+    async with bq.guard("history"):
+        table, field = await _locate(client, machine_id, field, start, end)
+        raw_count, out = await _run_history(
+            client, bqstorage_client, table, machine_id, field, start, end, points, method
+        )
+
+    metrics.observe("machines.history.bigquery", (time.perf_counter() - t0) * 1000)
+    return history_payload(machine_id, field, start, end, method, raw_count, out)
+
+async def _run_history(client, bqstorage_client, table, machine_id, field, start, end, points, method):
+    sql = f"""
+    SELECT UNIX_MILLIS(event_time) AS t, CAST(`{field}` AS FLOAT64) AS v
+    FROM {queries.table_ref(table)}
+    WHERE machine_id = @m
+      AND {queries.range_predicate()}
+      AND `{field}` IS NOT NULL
+    {"ORDER BY event_time" if method == "lttb" else ""}
+    """
+    job = await queries.submit(
+        client, sql, _range_params(machine_id, start, end), endpoint="machines.history"
+    )
+    return await bq.call(
+        lambda: reduce_batches(_iter_batches(job, bqstorage_client), start, end, points, method)
+    )
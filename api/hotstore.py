@@ -0,0 +1,208 @@
+# api/hotstore.py
+"""
+Optional in-memory hot telemetry store fed directly from MQTT.
+
+Enabled by setting HOT_STORE_MQTT_HOST. A background paho client subscribes
+to the telemetry topics and keeps a ring buffer per machine_id covering the
+last HOT_STORE_MINUTES, newest snapshot at the front. /api/machines/latest is
+served from here only while the feed is live (connected, with a message in
+the last HOT_STORE_STALE_S) and has been receiving without a break for the
+whole requested window; otherwise callers fall back to BigQuery.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Callable, Deque, Dict, List, Optional
+
+from fastapi import Request
+
+try:  # binary wire format (see fivetran_connector/decoding.py)
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MQTT_HOST  = os.getenv("HOT_STORE_MQTT_HOST", "")
+MQTT_PORT  = int(os.getenv("HOT_STORE_MQTT_PORT", "1883"))
+MQTT_USER  = os.getenv("HOT_STORE_MQTT_USER", "")
+MQTT_PASS  = os.getenv("HOT_STORE_MQTT_PASS", "")
+TOPIC      = os.getenv("HOT_STORE_TOPIC", "factory/+/telemetry/#")
+WINDOW_MIN = float(os.getenv("HOT_STORE_MINUTES", "15"))
+MAX_PER_MACHINE = int(os.getenv("HOT_STORE_MAX_PER_MACHINE", "3600"))
+STALE_S    = float(os.getenv("HOT_STORE_STALE_S", "30"))  # silence longer than this breaks the feed
+
+# Only what the API serves is kept per sample.
+FIELDS = ("ts", "machine_id", "name", "type", "power_w", "co2_kg_per_min", "scrap_rate_pct")
+
+# Binary schema v1 core layout; keep in sync with fivetran_connector/decoding.py.
+BINARY_V1 = 1
+CORE_FIELDS_V1 = (
+    "pk", "ts", "machine_id", "name", "type", "power_w", "co2_kg_per_min",
+    "noise_db", "ambient_temp_c", "scrap_rate_pct", "batch_id",
+)
+
+def decode_payload(topic: str, payload: bytes) -> Optional[Dict]:
+    """JSON, or version-byte + msgpack on .../telemetry/msgpack topics."""
+    if topic.endswith("/msgpack"):
+        if msgpack is None or not payload or payload[0] != BINARY_V1:
+            return None
+        values = msgpack.unpackb(memoryview(payload)[1:])
+        record = dict(zip(CORE_FIELDS_V1, values))
+        record.update(values[-1])
+        return record
+    record = json.loads(payload)
+    return record if isinstance(record, dict) else None
+
+def iso_ts(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+def to_item(sample: Dict) -> Dict:
+    """Hot-store sample → the item shape /api/machines/latest returns."""
+    return {
+        "machine_id": sample["machine_id"],
+        "name": sample["name"],
+        "type": sample["type"],
+        "ts": iso_ts(sample["ts"]),
+        "power_w": sample["power_w"],
+        "co2_kg_per_min": sample["co2_kg_per_min"],
+        "scrap_rate_pct": sample["scrap_rate_pct"],
+    }
+
+class HotStore:
+    def __init__(self, window_s: float, max_per_machine: int = MAX_PER_MACHINE,
+                 stale_s: float = STALE_S):
+        self.window_s = window_s
+        self.max_per_machine = max_per_machine
+        self.stale_s = stale_s
+        # Feed state (monotonic clock), updated from the MQTT thread
+        self.connected = False
+        self.receiving_since: Optional[float] = None  # start of the current unbroken feed
+        self.last_message_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._rings: Dict[str, Deque[Dict]] = {}
+        self._listeners: List[Callable[[Dict], None]] = []
+        self._record_listeners: List[Callable[[Dict], None]] = []
+        self._client = None
+
+    def add_listener(self, fn: Callable[[Dict], None], full: bool = False) -> None:
+        """
+        Call `fn(sample)` (from the MQTT thread) for every sample accepted into
+        the ring. With full=True `fn` gets every valid decoded record, sensors
+        included, late or redelivered ones too; it must handle ordering itself.
+        """
+        (self._record_listeners if full else self._listeners).append(fn)
+
+    # ---- ingest ----
+    def add(self, record: Dict) -> bool:
+        ts = record.get("ts")
+        mid = record.get("machine_id")
+        if not isinstance(ts, (int, float)) or not mid:
+            return False
+        # The late check below only keeps the ring's front newest; it doesn't
+        # decide what gets persisted.
+        for fn in self._record_listeners:
+            fn(record)
+        sample = {k: record.get(k) for k in FIELDS}
+        sample["ts"] = float(ts)
+        cutoff = sample["ts"] - self.window_s
+        with self._lock:
+            ring = self._rings.get(mid)
+            if ring is None:
+                ring = self._rings[mid] = deque(maxlen=self.max_per_machine)
+            if ring and sample["ts"] < ring[0]["ts"]:
+                return False  # late sample; the front is already newer
+            ring.appendleft(sample)
+            while ring and ring[-1]["ts"] < cutoff:
+                ring.pop()
+        for fn in self._listeners:
+            fn(sample)
+        return True
+
+    def _on_feed(self, connected: Optional[bool] = None) -> None:
+        now = time.monotonic()
+        if connected is not None:
+            self.connected = connected
+            self.receiving_since = None  # messages may have been missed either way
+            return
+        last = self.last_message_at
+        if self.receiving_since is None or last is None or now - last > self.stale_s:
+            self.receiving_since = now
+        self.last_message_at = now
+
+    # ---- queries ----
+    def covers(self, minutes: float) -> bool:
+        """
+        True when the feed is live and has been receiving without a gap for at
+        least `minutes`, and the buffer keeps that much.
+        """
+        now = time.monotonic()
+        if not self.connected or self.receiving_since is None or self.last_message_at is None:
+            return False
+        if now - self.last_message_at > self.stale_s:
+            return False
+        span = min(self.window_s, now - self.receiving_since)
+        return minutes * 60 <= span
+
+    def latest(self, minutes: float) -> List[Dict]:
+        cutoff = time.time() - minutes * 60
+        with self._lock:
+            fronts = [ring[0] for ring in self._rings.values() if ring]
+        rows = [dict(s) for s in fronts if s["ts"] >= cutoff]
+        rows.sort(key=lambda s: s["ts"], reverse=True)
+        return rows
+
+    # ---- MQTT feed ----
+    def start_mqtt(self, host: str, port: int, user: str, password: str, topic: str):
+        import paho.mqtt.client as mqtt
+
+        client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"api-hotstore-{uuid.uuid4().hex[:8]}",
+        )
+        if user:
+            client.username_pw_set(user, password)
+
+        def on_connect(c, userdata, flags, rc, *args):
+            if rc == 0:
+                c.subscribe(topic, qos=0)
+                self._on_feed(connected=True)
+
+        def on_disconnect(c, userdata, *args):
+            self._on_feed(connected=False)
+
+        def on_message(c, userdata, msg):
+            self._on_feed()
+            try:
+                record = decode_payload(msg.topic, msg.payload)
+            except Exception:
+                return
+            if record is not None:
+                self.add(record)
+
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_message = on_message
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        client.connect_async(host, port, keepalive=30)
+        client.loop_start()
+        self._client = client
+
+    def stop(self):
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+
+def create_hot_store() -> Optional[HotStore]:
+    """Start the MQTT-fed store if HOT_STORE_MQTT_HOST is configured (called from the lifespan)."""
+    if not MQTT_HOST:
+        return None
+    store = HotStore(window_s=WINDOW_MIN * 60)
+    store.start_mqtt(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS, TOPIC)
+    return store
+
+def get_hot_store(request: Request) -> Optional[HotStore]:
+    return getattr(request.app.state, "hot_store", None)
@@ -1,58 +1,151 @@
 # api/machines.py
-import os
-from fastapi import APIRouter, Query
-from google.cloud import bigquery
+import asyncio, json, os, time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Literal, Optional
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from api import bq, metrics
+from api.bq import ClientDisconnected, QueryTimeout
+from api.cache import TTLCache
+from api.history import HistoryError
+from api.hotstore import HotStore, get_hot_store, to_item
+from api.queries import QueryTooExpensive
+from api.storage import Storage, get_storage
+from api.stream import Broadcaster, get_broadcaster
 
-PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 router = APIRouter()
 
+STREAM_MIN_INTERVAL_S = float(os.getenv("STREAM_MIN_INTERVAL_S", "1.0"))  # per-client rate limit
+STREAM_KEEPALIVE_S    = float(os.getenv("STREAM_KEEPALIVE_S", "15"))
+STREAM_POLL_S         = float(os.getenv("STREAM_POLL_S", "5"))            # BigQuery fallback feed
+STREAM_MINUTES        = int(os.getenv("STREAM_MINUTES", "120"))
+HISTORY_MAX_DAYS      = int(os.getenv("HISTORY_MAX_DAYS", "31"))
+
+# Every dashboard viewer asks for the same few windows; share one storage
+# query (BigQuery job) per (minutes) per TTL instead of one per click.
+_latest_cache = TTLCache(
+    "latest",
+    ttl_s=float(os.getenv("LATEST_CACHE_TTL_S", "5")),
+    max_entries=int(os.getenv("LATEST_CACHE_MAX", "64")),
+)
+
 @router.get("/latest")
-def latest_metrics(minutes: int = Query(5, ge=1, le=1440)):
-    if not PROJECT_ID:
+async def latest_metrics(
+    request: Request,
+    minutes: int = Query(5, ge=1, le=1440),
+    storage: Optional[Storage] = Depends(get_storage),
+    hot: Optional[HotStore] = Depends(get_hot_store),
+):
+    # Served from the MQTT-fed buffer when it holds the whole window
+    if hot is not None and hot.covers(minutes):
+        metrics.incr("machines.latest.hot")
+        return _hot_latest(hot, minutes)
+
+    if storage is None:
         return {"error": "GOOGLE_CLOUD_PROJECT not set"}
 
-    client = bigquery.Client(project=PROJECT_ID)
-    sql = f"""
-    WITH t AS (
-      SELECT
-        machine_id,
-        name,
-        type,
-        TIMESTAMP_MILLIS(CAST(ts * 1000 AS INT64)) AS ts,
-        power_w,
-        co_2_kg_per_min AS co2_kg_per_min,
-        scrap_rate_pct
-      FROM `{PROJECT_ID}.cookie_factory_mqtt.telemetry`
-      WHERE TIMESTAMP_MILLIS(CAST(ts * 1000 AS INT64)) >=
-            TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @m MINUTE)
-    )
-    SELECT * EXCEPT(rn)
-    FROM (
-      SELECT t.*, ROW_NUMBER() OVER (PARTITION BY machine_id ORDER BY ts DESC) AS rn
-      FROM t
-    )
-    WHERE rn = 1
-    ORDER BY ts DESC
+    try:
+        return await bq.cancel_on_disconnect(
+            request, _latest_cache.get_or_load(minutes, lambda: _query_latest(storage, minutes))
+        )
+    except QueryTooExpensive as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except QueryTimeout as e:
+        return JSONResponse({"error": str(e)}, status_code=504)
+    except ClientDisconnected:
+        return Response(status_code=499)
+
+@router.get("/stream")
+async def stream_metrics(
+    request: Request,
+    storage: Optional[Storage] = Depends(get_storage),
+    hot: Optional[HotStore] = Depends(get_hot_store),
+    broadcaster: Broadcaster = Depends(get_broadcaster),
+):
     """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("m", "INT64", minutes)]
-        ),
+    Server-sent events: one `telemetry` event per machine whose snapshot
+    changed. All tabs share one upstream feed (hot store or a single storage
+    poller); each client is sent at most one batch per STREAM_MIN_INTERVAL_S
+    and slow clients only ever receive the newest snapshot per machine.
+    """
+    if hot is None:
+        if storage is None:
+            return JSONResponse({"error": "no telemetry feed configured"}, status_code=503)
+        async def load():
+            data = await _latest_cache.get_or_load(
+                STREAM_MINUTES, lambda: _query_latest(storage, STREAM_MINUTES)
+            )
+            return data["items"]
+
+        broadcaster.ensure_poller(load, STREAM_POLL_S)
+
+    sub = broadcaster.subscribe()
+    if sub is None:
+        return JSONResponse({"error": "too many stream clients"}, status_code=503)
+    metrics.incr("machines.stream.connect")
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                items = await sub.next(STREAM_KEEPALIVE_S)
+                if items is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                sent_at = time.monotonic()
+                for item in items:
+                    yield f"event: telemetry\ndata: {json.dumps(item, separators=(',', ':'))}\n\n"
+                # Rate limit: anything arriving meanwhile is coalesced per machine.
+                await asyncio.sleep(max(0.0, STREAM_MIN_INTERVAL_S - (time.monotonic() - sent_at)))
+        finally:
+            broadcaster.unsubscribe(sub)
+            metrics.incr("machines.stream.coalesced", sub.coalesced)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    rows = list(job.result())
-    return {
-        "items": [
-            {
-                "machine_id": r["machine_id"],
-                "name": r["name"],
-                "type": r["type"],
-                "ts": r["ts"].isoformat(),
-                "power_w": r["power_w"],
-                "co2_kg_per_min": r["co2_kg_per_min"],
-                "scrap_rate_pct": r["scrap_rate_pct"],
-            }
-            for r in rows
-        ],
-        "count": len(rows),
-    }
+
+@router.get("/{machine_id}/history")
+async def machine_history(
+    request: Request,
+    machine_id: str,
+    field: str = Query("power_w", description="core metric or sensor column"),
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    points: int = Query(500, ge=10, le=5000),
+    method: Literal["minmax", "lttb"] = "minmax",
+    storage: Optional[Storage] = Depends(get_storage),
+):
+    """Time series for one machine/field, downsampled server-side to `points`."""
+    if storage is None:
+        return {"error": "GOOGLE_CLOUD_PROJECT not set"}
+
+    end = _as_utc(end) if end else datetime.now(timezone.utc)
+    start = _as_utc(start) if start else end - timedelta(hours=1)
+    if end - start > timedelta(days=HISTORY_MAX_DAYS):
+        return JSONResponse({"error": f"range exceeds {HISTORY_MAX_DAYS} days"}, status_code=400)
+    try:
+        return await bq.cancel_on_disconnect(
+            request,
+            storage.history(machine_id, field, start, end, points, method),
+        )
+    except (HistoryError, QueryTooExpensive) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except QueryTimeout as e:
+        return JSONResponse({"error": str(e)}, status_code=504)
+    except ClientDisconnected:
+        return Response(status_code=499)
+
+def _as_utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+def _hot_latest(hot: HotStore, minutes: int) -> Dict:
+    items = [to_item(r) for r in hot.latest(minutes)]
+    return {"items": items, "count": len(items)}
+
+async def _query_latest(storage: Storage, minutes: int) -> Dict:
+    items = await storage.latest(minutes)
+    return {"items": items, "count": len(items)}
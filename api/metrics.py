@@ -0,0 +1,45 @@
+# api/metrics.py
+"""
+Tiny in-process metrics registry: counters plus bounded latency reservoirs.
+Exposed as JSON at GET /api/metrics.
+"""
+import threading
+from collections import deque
+from typing import Deque, Dict
+
+SAMPLES_PER_TIMER = 1024
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = {}
+_timers: Dict[str, Deque[float]] = {}
+
+def incr(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def observe(name: str, value_ms: float) -> None:
+    with _lock:
+        buf = _timers.get(name)
+        if buf is None:
+            buf = _timers[name] = deque(maxlen=SAMPLES_PER_TIMER)
+        buf.append(value_ms)
+
+def _pct(sorted_vals, p: float) -> float:
+    return sorted_vals[min(len(sorted_vals) - 1, int(round(p / 100 * (len(sorted_vals) - 1))))]
+
+def snapshot() -> Dict:
+    with _lock:
+        counters = dict(_counters)
+        timers = {k: sorted(v) for k, v in _timers.items() if v}
+    return {
+        "counters": counters,
+        "timings_ms": {
+            k: {
+                "count": len(v),
+                "p50": round(_pct(v, 50), 2),
+                "p99": round(_pct(v, 99), 2),
+                "max": round(v[-1], 2),
+            }
+            for k, v in timers.items()
+        },
+    }
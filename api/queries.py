@@ -0,0 +1,148 @@
+# api/queries.py
+"""
+Shared BigQuery SQL for the API routes.
+
+Window queries filter on the stored partition column (`event_time`) with a
+bare comparison, never on an expression of it, so BigQuery can prune
+partitions. Every query goes through run(): a dry run first (cached per
+SQL + parameters) rejects anything estimated above BQ_MAX_BYTES_BILLED, the
+real job carries the same `maximum_bytes_billed` cap, and bytes processed /
+slot-ms are recorded per endpoint in api.metrics and printed to the log.
+"""
+import os, time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from google.cloud import bigquery
+
+from api import bq, metrics
+
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
+DATASET    = os.getenv("BQ_DATASET", "cookie_factory_mqtt")
+TABLE      = os.getenv("BQ_TABLE", "telemetry")
+# One row per machine, maintained by the connector (LATEST_TABLE=true);
+# set BQ_LATEST_TABLE="" to rank the raw window instead. If the table doesn't
+# exist yet, readers fall back to ranking the window and retry it after
+# LATEST_TABLE_RETRY_S.
+LATEST_TABLE = os.getenv("BQ_LATEST_TABLE", f"{TABLE}_latest")
+LATEST_TABLE_RETRY_S = float(os.getenv("BQ_LATEST_TABLE_RETRY_S", "300"))
+# Per-minute rollups written by the connector (ROLLUP_1M=true)
+ROLLUP_TABLE = os.getenv("BQ_ROLLUP_TABLE", f"{TABLE}_1m")
+
+MAX_BYTES_BILLED = int(os.getenv("BQ_MAX_BYTES_BILLED", str(1 << 30)))  # 1 GiB
+DRY_RUN_TTL_S    = float(os.getenv("BQ_DRY_RUN_TTL_S", "300"))
+DRY_RUN_CACHE_MAX = 256
+
+# (sql, params) -> (expires_at, estimated bytes)
+_estimates: Dict[Tuple, Tuple[float, int]] = {}
+
+class QueryTooExpensive(Exception):
+    pass
+
+def table_ref(table: str = TABLE) -> str:
+    return f"`{PROJECT_ID}.{DATASET}.{table}`"
+
+def window_predicate(column: str = "event_time", param: str = "m") -> str:
+    """Sargable 'last @m minutes' filter on the partition column."""
+    return f"{column} >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @{param} MINUTE)"
+
+def range_predicate(column: str = "event_time") -> str:
+    """Sargable half-open [@from, @to) filter on the partition column."""
+    return f"{column} >= @from AND {column} < @to"
+
+def latest_per_machine(
+    columns: Sequence[str], table: str = TABLE, latest_table: Optional[str] = LATEST_TABLE
+) -> str:
+    """Newest row per machine inside the last @m minutes, newest first."""
+    if latest_table:
+        # Point lookup; @m only drops machines that have gone quiet.
+        return f"""
+    SELECT {", ".join(columns)}, event_time AS ts
+    FROM {table_ref(latest_table)}
+    WHERE {window_predicate()}
+    ORDER BY ts DESC
+    """
+    return f"""
+    SELECT {", ".join(columns)}, event_time AS ts
+    FROM {table_ref(table)}
+    WHERE {window_predicate()}
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY machine_id ORDER BY event_time DESC) = 1
+    ORDER BY ts DESC
+    """
+
+def window_aggregates(co2_column: str) -> str:
+    """Per-machine totals over the last @m minutes from the 1-minute rollups."""
+    return f"""
+    SELECT
+      machine_id,
+      SUM(kwh) AS kwh,
+      SUM(`{co2_column}`) AS co2_kg,
+      SAFE_DIVIDE(SUM(power_w_mean * `count`), SUM(`count`)) AS avg_power_w,
+      MAX(scrap_rate_pct_max) AS max_scrap_rate_pct
+    FROM {table_ref(ROLLUP_TABLE)}
+    WHERE {window_predicate("minute_start")}
+    GROUP BY machine_id
+    """
+
+def job_config(params: Iterable = (), dry_run: bool = False) -> bigquery.QueryJobConfig:
+    cfg = bigquery.QueryJobConfig(
+        query_parameters=list(params), maximum_bytes_billed=MAX_BYTES_BILLED
+    )
+    if dry_run:
+        cfg.dry_run = True
+        cfg.use_query_cache = False
+    return cfg
+
+async def check_cost(
+    client: bigquery.Client, sql: str, params: Sequence, endpoint: str
+) -> int:
+    """Dry-run estimate of bytes processed; raises QueryTooExpensive above the cap."""
+    key = (sql, tuple((p.name, p.type_, str(p.value)) for p in params))
+    hit = _estimates.get(key)
+    if hit is not None and hit[0] > time.monotonic():
+        estimate = hit[1]
+    else:
+        job = await bq.call(client.query, sql, job_config=job_config(params, dry_run=True))
+        estimate = int(job.total_bytes_processed or 0)
+        _estimates[key] = (time.monotonic() + DRY_RUN_TTL_S, estimate)
+        while len(_estimates) > DRY_RUN_CACHE_MAX:
+            del _estimates[next(iter(_estimates))]
+    if estimate > MAX_BYTES_BILLED:
+        metrics.incr(f"bq.{endpoint}.rejected")
+        raise QueryTooExpensive(
+            f"{endpoint} query would scan {estimate:,} bytes (limit {MAX_BYTES_BILLED:,})"
+        )
+    return estimate
+
+def record_stats(endpoint: str, job: bigquery.QueryJob) -> None:
+    processed = int(job.total_bytes_processed or 0)
+    slot_ms = int(job.slot_millis or 0)
+    metrics.incr(f"bq.{endpoint}.bytes_processed", processed)
+    metrics.incr(f"bq.{endpoint}.slot_ms", slot_ms)
+    metrics.incr(f"bq.{endpoint}.jobs")
+    print(
+        f"[bq] {endpoint} bytes_processed={processed} slot_ms={slot_ms}"
+        f" cache_hit={bool(job.cache_hit)}",
+        flush=True,
+    )
+
+async def submit(
+    client: bigquery.Client, sql: str, params: Sequence, *, endpoint: str
+) -> bigquery.QueryJob:
+    """Cost-check then start and await the job (caller holds bq.guard)."""
+    await check_cost(client, sql, params, endpoint)
+    job = await bq.submit_and_wait(client, sql, job_config(params))
+    record_stats(endpoint, job)
+    return job
+
+async def run(
+    client: bigquery.Client,
+    sql: str,
+    params: Sequence = (),
+    *,
+    route: str,
+    endpoint: Optional[str] = None,
+) -> List[bigquery.Row]:
+    """Guarded, cost-checked query returning all rows."""
+    async with bq.guard(route):
+        job = await submit(client, sql, params, endpoint=endpoint or route)
+        return await bq.call(lambda: list(job.result()))
@@ -0,0 +1,105 @@
+# api/schema.py
+"""
+Cached column metadata for the telemetry dataset.
+
+Fivetran renames columns on the way in (co2_kg_per_min -> co_2_kg_per_min,
+zone1_temp_c -> zone_1_temp_c), and older tables may still carry the raw
+names. Instead of probing INFORMATION_SCHEMA on every request, the whole
+dataset's {table: {column: data_type}} map is loaded once (single-flight)
+and kept for SCHEMA_CACHE_TTL_S. resolve() maps a logical field name to
+whichever spelling the table actually has. A query that fails with
+"Unrecognized name" invalidates the map and is retried once via
+retry_on_missing_column().
+"""
+import os, re, time
+from typing import Awaitable, Callable, Collection, Dict, Iterable, Optional, TypeVar
+
+from google.api_core.exceptions import BadRequest, GoogleAPICallError
+from google.cloud import bigquery
+
+from api import metrics, queries
+from api.cache import TTLCache
+
+SCHEMA_TTL_S = float(os.getenv("SCHEMA_CACHE_TTL_S", "3600"))
+# After a failed metadata lookup, callers use their defaults for this long
+# before it is retried (failures are not cached for the full TTL).
+SCHEMA_RETRY_S = float(os.getenv("SCHEMA_RETRY_S", "30"))
+
+_cache = TTLCache("schema", ttl_s=SCHEMA_TTL_S, max_entries=4)
+_retry_at = 0.0  # monotonic; no lookups before this after a failure
+
+NUMERIC_TYPES = {"INT64", "FLOAT64", "NUMERIC", "BIGNUMERIC"}
+
+T = TypeVar("T")
+
+def fivetran_name(name: str) -> str:
+    return re.sub(r"(?<=[a-z])(?=[0-9])", "_", name)  # co2 -> co_2, zone1 -> zone_1
+
+def raw_name(name: str) -> str:
+    return re.sub(r"(?<=[a-z])_(?=[0-9])", "", name)  # co_2 -> co2
+
+def candidates(name: str) -> Iterable[str]:
+    """Spellings to try for a logical column: Fivetran-normalised first, then as given."""
+    seen = []
+    for c in (fivetran_name(name), name, raw_name(name)):
+        if c not in seen:
+            seen.append(c)
+    return seen
+
+def match(columns: Collection[str], name: str) -> Optional[str]:
+    for c in candidates(name):
+        if c in columns:
+            return c
+    return None
+
+def is_numeric(data_type: Optional[str]) -> bool:
+    return (data_type or "").upper() in NUMERIC_TYPES
+
+async def columns(client: bigquery.Client) -> Dict[str, Dict[str, str]]:
+    """{table_name: {column: data_type}} for the dataset; {} if metadata is unavailable."""
+    global _retry_at
+    if time.monotonic() < _retry_at:
+        return {}
+    try:
+        return await _cache.get_or_load(queries.DATASET, lambda: _load(client))
+    except GoogleAPICallError as e:
+        # Callers fall back to their default names until SCHEMA_RETRY_S has passed.
+        _retry_at = time.monotonic() + SCHEMA_RETRY_S
+        metrics.incr("schema.lookup_failed")
+        print(f"[schema] metadata lookup failed: {e}", flush=True)
+        return {}
+
+async def _load(client: bigquery.Client) -> Dict[str, Dict[str, str]]:
+    sql = f"""
+    SELECT table_name, column_name, data_type
+    FROM `{queries.PROJECT_ID}.{queries.DATASET}.INFORMATION_SCHEMA.COLUMNS`
+    """
+    rows = await queries.run(client, sql, route="schema", endpoint="schema.columns")
+    tables: Dict[str, Dict[str, str]] = {}
+    for r in rows:
+        tables.setdefault(r["table_name"], {})[r["column_name"]] = r["data_type"]
+    return tables
+
+async def resolve(client: bigquery.Client, table: str, name: str, default: Optional[str] = None) -> Optional[str]:
+    """Physical column for `name` in `table`; `default` if the table or column is unknown."""
+    cols = (await columns(client)).get(table)
+    if cols is None:
+        return default
+    return match(cols, name) or default
+
+def invalidate() -> None:
+    metrics.incr("schema.invalidate")
+    _cache.invalidate(queries.DATASET)
+
+def is_missing_column(e: Exception) -> bool:
+    return isinstance(e, BadRequest) and "Unrecognized name" in str(e)
+
+async def retry_on_missing_column(fn: Callable[[], Awaitable[T]]) -> T:
+    """Run `fn`; if BigQuery rejects a column name, refresh the metadata and try once more."""
+    try:
+        return await fn()
+    except BadRequest as e:
+        if not is_missing_column(e):
+            raise
+        invalidate()
+        return await fn()
@@ -0,0 +1,375 @@
+# api/storage.py
+"""
+Telemetry storage backends behind one small async interface.
+
+STORAGE_BACKEND picks the implementation created in the app lifespan:
+
+  bigquery (default)  the Fivetran-fed BigQuery dataset (api.queries / api.history)
+  duckdb              an embedded DuckDB file, fed from the hot store's MQTT
+                      subscription and optionally seeded from Parquet files
+
+The DuckDB tier lets the API run (and be load-tested) without a GCP project,
+and can serve as a low-latency local tier for recent data at the edge.
+Both backends return the same shapes: latest() -> list of /latest items,
+history() -> the /history payload.
+"""
+import asyncio, json, os, threading, time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from api import metrics, queries, schema
+from api.history import check_request, fetch_history, history_payload, reduce_batches
+from api.hotstore import HotStore, iso_ts
+
+try:  # embedded backend (pip install duckdb)
+    import duckdb
+except ImportError:
+    duckdb = None
+
+BACKEND          = os.getenv("STORAGE_BACKEND", "bigquery").lower()
+DUCKDB_PATH      = os.getenv("DUCKDB_PATH", "telemetry.duckdb")
+DUCKDB_PARQUET   = os.getenv("DUCKDB_PARQUET", "")  # e.g. data/telemetry/*.parquet
+DUCKDB_RETENTION_H = float(os.getenv("DUCKDB_RETENTION_HOURS", "0"))  # 0 keeps everything
+DUCKDB_FLUSH_ROWS  = int(os.getenv("DUCKDB_FLUSH_ROWS", "500"))
+DUCKDB_FLUSH_S     = float(os.getenv("DUCKDB_FLUSH_SECONDS", "1"))
+
+AGGREGATE_FIELDS = ("avg_power_w", "max_scrap_rate_pct", "kwh", "co2_kg")
+
+class Storage(ABC):
+    name = "base"
+
+    # `route` picks the bq.ROUTE_LIMITS slot pool and `endpoint` the metrics
+    # name the read is counted under; backends without limits ignore both.
+    @abstractmethod
+    async def latest(
+        self, minutes: int, *, route: str = "latest", endpoint: str = "machines.latest"
+    ) -> List[Dict]:
+        ...
+
+    async def aggregates(
+        self, minutes: int, *, route: str = "chat", endpoint: str = "ai.aggregates"
+    ) -> Dict[str, Dict]:
+        """machine_id -> {avg_power_w, max_scrap_rate_pct, kwh, co2_kg} over the window."""
+        return {}
+
+    @abstractmethod
+    async def history(
+        self, machine_id: str, field: str, start: datetime, end: datetime, points: int, method: str
+    ) -> Dict:
+        ...
+
+    def close(self) -> None:
+        pass
+
+class BigQueryStorage(Storage):
+    name = "bigquery"
+
+    def __init__(self, client: bigquery.Client, bqstorage_client=None):
+        self.client = client
+        self.bqstorage_client = bqstorage_client
+        self._latest_missing_until = 0.0  # monotonic; LATEST_TABLE not found before then
+
+    async def latest(
+        self, minutes: int, *, route: str = "latest", endpoint: str = "machines.latest"
+    ) -> List[Dict]:
+        t0 = time.perf_counter()
+        rows = await schema.retry_on_missing_column(lambda: self._latest(minutes, route, endpoint))
+        metrics.observe(f"{endpoint}.bigquery", (time.perf_counter() - t0) * 1000)
+        return [
+            {
+                "machine_id": r["machine_id"],
+                "name": r["name"],
+                "type": r["type"],
+                "ts": r["ts"].isoformat(),
+                "power_w": r["power_w"],
+                "co2_kg_per_min": r["co2_kg_per_min"],
+                "scrap_rate_pct": r["scrap_rate_pct"],
+            }
+            for r in rows
+        ]
+
+    async def _latest(self, minutes: int, route: str, endpoint: str) -> List[bigquery.Row]:
+        latest_table = queries.LATEST_TABLE
+        if latest_table and time.monotonic() >= self._latest_missing_until:
+            try:
+                return await self._latest_from(latest_table, minutes, route, endpoint)
+            except NotFound as e:
+                # Connector hasn't created it yet (or LATEST_TABLE=false there)
+                self._latest_missing_until = time.monotonic() + queries.LATEST_TABLE_RETRY_S
+                metrics.incr("machines.latest.latest_table_missing")
+                print(f"[bq] {latest_table} not found, ranking {queries.TABLE} instead: {e}", flush=True)
+        return await self._latest_from(None, minutes, route, endpoint)
+
+    async def _latest_from(
+        self, latest_table: Optional[str], minutes: int, route: str, endpoint: str
+    ) -> List[bigquery.Row]:
+        table = latest_table or queries.TABLE
+        co2_col = await schema.resolve(self.client, table, "co2_kg_per_min", "co_2_kg_per_min")
+        sql = queries.latest_per_machine(
+            ["machine_id", "name", "type", "power_w",
+             f"`{co2_col}` AS co2_kg_per_min", "scrap_rate_pct"],
+            latest_table=latest_table,
+        )
+        return await queries.run(
+            self.client,
+            sql,
+            [bigquery.ScalarQueryParameter("m", "INT64", minutes)],
+            route=route,
+            endpoint=endpoint,
+        )
+
+    async def aggregates(
+        self, minutes: int, *, route: str = "chat", endpoint: str = "ai.aggregates"
+    ) -> Dict[str, Dict]:
+        rows = await schema.retry_on_missing_column(
+            lambda: self._aggregates(minutes, route, endpoint)
+        )
+        return {r["machine_id"]: {k: r[k] for k in AGGREGATE_FIELDS} for r in rows}
+
+    async def _aggregates(self, minutes: int, route: str, endpoint: str) -> List[bigquery.Row]:
+        co2_col = await schema.resolve(self.client, queries.ROLLUP_TABLE, "co2_kg", "co_2_kg")
+        return await queries.run(
+            self.client,
+            queries.window_aggregates(co2_col),
+            [bigquery.ScalarQueryParameter("m", "INT64", minutes)],
+            route=route,
+            endpoint=endpoint,
+        )
+
+    async def history(self, machine_id, field, start, end, points, method):
+        return await schema.retry_on_missing_column(
+            lambda: fetch_history(
+                self.client, self.bqstorage_client, machine_id, field, start, end, points, method
+            )
+        )
+
+# ---- embedded DuckDB ----
+# Raw-record column layout; sensors vary by machine type and go into a JSON column.
+DUCK_CORE = ("power_w", "co2_kg_per_min", "noise_db", "ambient_temp_c", "scrap_rate_pct")
+DUCK_COLUMNS = ("pk", "ts", "machine_id", "name", "type", *DUCK_CORE, "batch_id")
+
+_DUCK_DDL = f"""
+CREATE TABLE IF NOT EXISTS telemetry (
+  pk VARCHAR PRIMARY KEY, ts DOUBLE, machine_id VARCHAR, name VARCHAR, type VARCHAR,
+  {", ".join(f"{c} DOUBLE" for c in DUCK_CORE)}, batch_id VARCHAR, sensors JSON
+);
+CREATE TABLE IF NOT EXISTS telemetry_latest (
+  machine_id VARCHAR PRIMARY KEY, ts DOUBLE, name VARCHAR, type VARCHAR,
+  power_w DOUBLE, co2_kg_per_min DOUBLE, scrap_rate_pct DOUBLE
+);
+"""
+_LATEST_COLS = ("machine_id", "ts", "name", "type", "power_w", "co2_kg_per_min", "scrap_rate_pct")
+
+class DuckDBStorage(Storage):
+    """
+    Embedded columnar store. ingest() buffers decoded MQTT records and writes
+    them in batches (DUCKDB_FLUSH_ROWS / DUCKDB_FLUSH_SECONDS); like the
+    BigQuery side, a telemetry_latest row per machine is kept current on
+    write so latest() is a point lookup. Reads run off the event loop on
+    their own cursor.
+    """
+    name = "duckdb"
+
+    def __init__(self, path: str = DUCKDB_PATH, parquet_glob: str = DUCKDB_PARQUET,
+                 retention_h: float = DUCKDB_RETENTION_H):
+        if duckdb is None:
+            raise RuntimeError("STORAGE_BACKEND=duckdb needs the duckdb package")
+        self.retention_s = retention_h * 3600
+        self._con = duckdb.connect(path)
+        self._con.execute(_DUCK_DDL)
+        self._source = "telemetry"
+        if parquet_glob:
+            # Seed data (e.g. an export) is queried in place, unioned with live rows.
+            glob = parquet_glob.replace("'", "''")  # views can't take bound parameters
+            self._con.execute(
+                "CREATE OR REPLACE VIEW telemetry_all AS "
+                "SELECT * FROM telemetry UNION ALL BY NAME "
+                f"SELECT * FROM read_parquet('{glob}', union_by_name = true)"
+            )
+            self._source = "telemetry_all"
+            self._refresh_latest(self._con)
+        self._lock = threading.Lock()
+        self._buf: List[tuple] = []
+        self._last_flush = time.monotonic()
+        self._last_prune = 0.0
+
+    # ---- ingest (MQTT thread) ----
+    def ingest(self, record: Dict) -> None:
+        if not record.get("pk") or not isinstance(record.get("ts"), (int, float)):
+            return
+        sensors = {k: v for k, v in record.items() if k not in DUCK_COLUMNS}
+        row = tuple(record.get(c) for c in DUCK_COLUMNS) + (json.dumps(sensors),)
+        with self._lock:
+            self._buf.append(row)
+            due = (len(self._buf) >= DUCKDB_FLUSH_ROWS
+                   or time.monotonic() - self._last_flush >= DUCKDB_FLUSH_S)
+            if due:
+                rows, self._buf = self._buf, []
+                self._last_flush = time.monotonic()
+        if due:
+            self._write(rows)
+
+    def flush(self) -> None:
+        with self._lock:
+            rows, self._buf = self._buf, []
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows: List[tuple]) -> None:
+        cols = (*DUCK_COLUMNS, "sensors")
+        cur = self._con.cursor()
+        try:
+            cur.execute("BEGIN")
+            cur.executemany(
+                f"INSERT OR IGNORE INTO telemetry ({', '.join(cols)}) "
+                f"VALUES ({', '.join('?' for _ in cols)})",
+                rows,
+            )
+            newest: Dict[str, tuple] = {}
+            for r in rows:
+                mid = r[2]
+                if mid not in newest or r[1] > newest[mid][1]:
+                    newest[mid] = r
+            cur.executemany(
+                f"INSERT INTO telemetry_latest ({', '.join(_LATEST_COLS)}) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (machine_id) DO UPDATE SET "
+                + ", ".join(f"{c} = excluded.{c}" for c in _LATEST_COLS[1:])
+                + " WHERE excluded.ts > telemetry_latest.ts",
+                [(r[2], r[1], r[3], r[4], r[5], r[6], r[9]) for r in newest.values()],
+            )
+            now = time.time()
+            if self.retention_s and now - self._last_prune > 60:
+                cur.execute("DELETE FROM telemetry WHERE ts < ?", [now - self.retention_s])
+                self._last_prune = now
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.close()
+        metrics.incr("storage.duckdb.rows", len(rows))
+
+    def _refresh_latest(self, con) -> None:
+        con.execute(
+            f"INSERT OR REPLACE INTO telemetry_latest "
+            f"SELECT {', '.join(_LATEST_COLS)} FROM {self._source} "
+            "QUALIFY ROW_NUMBER() OVER (PARTITION BY machine_id ORDER BY ts DESC) = 1"
+        )
+
+    # ---- queries ----
+    async def latest(
+        self, minutes: int, *, route: str = "latest", endpoint: str = "machines.latest"
+    ) -> List[Dict]:
+        t0 = time.perf_counter()
+        rows = await asyncio.to_thread(self._latest, time.time() - minutes * 60)
+        metrics.observe(f"{endpoint}.duckdb", (time.perf_counter() - t0) * 1000)
+        return rows
+
+    def _latest(self, cutoff: float) -> List[Dict]:
+        cur = self._con.cursor()
+        try:
+            rows = cur.execute(
+                f"SELECT {', '.join(_LATEST_COLS)} FROM telemetry_latest "
+                "WHERE ts >= ? ORDER BY ts DESC",
+                [cutoff],
+            ).fetchall()
+        finally:
+            cur.close()
+        items = []
+        for r in rows:
+            item = dict(zip(_LATEST_COLS, r))
+            item["ts"] = iso_ts(item["ts"])
+            items.append(item)
+        return items
+
+    async def aggregates(
+        self, minutes: int, *, route: str = "chat", endpoint: str = "ai.aggregates"
+    ) -> Dict[str, Dict]:
+        return await asyncio.to_thread(self._aggregates, time.time() - minutes * 60)
+
+    def _aggregates(self, cutoff: float) -> Dict[str, Dict]:
+        # No rollup table here: average rates times the observed span.
+        cur = self._con.cursor()
+        try:
+            rows = cur.execute(
+                f"""
+                SELECT machine_id, avg(power_w), max(scrap_rate_pct),
+                       avg(co2_kg_per_min), max(ts) - min(ts)
+                FROM {self._source} WHERE ts >= ? GROUP BY machine_id
+                """,
+                [cutoff],
+            ).fetchall()
+        finally:
+            cur.close()
+        out = {}
+        for mid, power, scrap, co2, span_s in rows:
+            out[mid] = {
+                "avg_power_w": power,
+                "max_scrap_rate_pct": scrap,
+                "kwh": power * span_s / 3.6e6 if power is not None else None,
+                "co2_kg": co2 * span_s / 60 if co2 is not None else None,
+            }
+        return out
+
+    async def history(self, machine_id, field, start, end, points, method):
+        field = schema.raw_name(field)  # records keep the publisher's names (co2, zone1)
+        check_request(field, start, end)
+        t0 = time.perf_counter()
+        raw_count, out = await asyncio.to_thread(
+            self._history, machine_id, field, start, end, points, method
+        )
+        metrics.observe("machines.history.duckdb", (time.perf_counter() - t0) * 1000)
+        return history_payload(machine_id, field, start, end, method, raw_count, out)
+
+    def _history(self, machine_id, field, start, end, points, method):
+        if field in DUCK_CORE:
+            value, params = f"{field}", []
+        else:
+            value, params = "TRY_CAST(json_extract_string(sensors, ?) AS DOUBLE)", [f"$.{field}"]
+        sql = f"""
+        SELECT t, v FROM (
+          SELECT ts * 1000 AS t, {value} AS v
+          FROM {self._source}
+          WHERE machine_id = ? AND ts >= ? AND ts < ?
+        ) WHERE v IS NOT NULL
+        {"ORDER BY t" if method == "lttb" else ""}
+        """
+        cur = self._con.cursor()
+        try:
+            cur.execute(sql, [*params, machine_id, start.timestamp(), end.timestamp()])
+
+            def batches():
+                while True:
+                    chunk = cur.fetchmany(50_000)
+                    if not chunk:
+                        return
+                    yield [r[0] for r in chunk], [r[1] for r in chunk]
+
+            return reduce_batches(batches(), start, end, points, method)
+        finally:
+            cur.close()
+
+    def close(self) -> None:
+        self.flush()
+        self._con.close()
+
+def create_storage(
+    client: Optional[bigquery.Client], bqstorage_client=None, hot_store: Optional[HotStore] = None
+) -> Optional[Storage]:
+    """Build the STORAGE_BACKEND store (called from the app lifespan); None if unconfigured."""
+    if BACKEND == "duckdb":
+        store = DuckDBStorage()
+        if hot_store is not None:
+            hot_store.add_listener(store.ingest, full=True)
+        return store
+    if client is None or not queries.PROJECT_ID:
+        return None
+    return BigQueryStorage(client, bqstorage_client)
+
+def get_storage(request: Request) -> Optional[Storage]:
+    return getattr(request.app.state, "storage", None)
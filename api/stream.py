@@ -0,0 +1,108 @@
+# api/stream.py
+"""
+Fan-out of live telemetry to many SSE clients from a single upstream feed.
+
+The upstream is either the MQTT-fed hot store (push) or, without one, a
+single shared poller over the cached BigQuery "latest" loader. Each client
+gets a Subscription whose pending updates are a dict keyed by machine_id, so
+a slow client never builds an unbounded queue: newer snapshots simply
+replace older ones until the client catches up.
+"""
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from fastapi import Request
+
+class Subscription:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict] = {}
+        self._event = asyncio.Event()
+        self._signalled = False
+        self.coalesced = 0
+
+    def offer(self, item: Dict) -> None:
+        """Thread-safe; keeps only the newest item per machine."""
+        with self._lock:
+            if item["machine_id"] in self._pending:
+                self.coalesced += 1
+            self._pending[item["machine_id"]] = item
+            if self._signalled:
+                return
+            self._signalled = True
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def next(self, timeout: float) -> Optional[List[Dict]]:
+        """Wait for updates; returns None on timeout (caller sends a keep-alive)."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        with self._lock:
+            self._event.clear()
+            self._signalled = False
+            items, self._pending = list(self._pending.values()), {}
+        return items
+
+class Broadcaster:
+    def __init__(self, max_clients: int = 500):
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        self._subs: Set[Subscription] = set()
+        self._last: Dict[str, Dict] = {}
+        self._poller: Optional[asyncio.Task] = None
+
+    def publish(self, item: Dict) -> None:
+        """Push one machine snapshot to every subscriber if it is new (thread-safe)."""
+        mid = item.get("machine_id")
+        if not mid:
+            return
+        with self._lock:
+            prev = self._last.get(mid)
+            if prev is not None and prev.get("ts") == item.get("ts"):
+                return
+            self._last[mid] = item
+            subs = list(self._subs)
+        for sub in subs:
+            sub.offer(item)
+
+    def subscribe(self) -> Optional[Subscription]:
+        """New subscription primed with the current snapshot; None when full."""
+        sub = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            if len(self._subs) >= self.max_clients:
+                return None
+            self._subs.add(sub)
+            snapshot = list(self._last.values())
+        for item in snapshot:
+            sub.offer(item)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            self._subs.discard(sub)
+
+    @property
+    def clients(self) -> int:
+        with self._lock:
+            return len(self._subs)
+
+    def ensure_poller(self, load: Callable[[], Awaitable[List[Dict]]], interval_s: float) -> None:
+        """Start the shared poller (no hot store) unless one is already running."""
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll(load, interval_s))
+
+    async def _poll(self, load: Callable[[], Awaitable[List[Dict]]], interval_s: float) -> None:
+        while self.clients:
+            try:
+                items = await load()
+            except Exception:
+                items = []
+            for item in items:
+                self.publish(item)
+            await asyncio.sleep(interval_s)
+
+def get_broadcaster(request: Request) -> Broadcaster:
+    return request.app.state.broadcaster
@@ -0,0 +1,77 @@
+# api/vertex.py
+"""
+One warm Vertex AI model handle per process.
+
+vertex_init() (credential load) and GenerativeModel construction used to run
+on every chat request. VertexModel builds the handle once: eagerly from the
+app lifespan (warm(), in the background so startup isn't blocked) or lazily
+on first use behind a lock, and every request reuses it. slot() bounds the
+number of in-flight generations to VERTEX_MAX_CONCURRENCY so bursts queue
+here instead of tripping the project's quota.
+
+Metrics: vertex.cold_start (build time), vertex.queue_wait (time waiting
+for a slot); ai.chat.model in api/ai.py is the per-request cost of getting
+the handle, ~0 once warm.
+"""
+import asyncio, os, time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import Request
+from vertexai import init as vertex_init
+from vertexai.generative_models import GenerativeModel
+
+from api import metrics
+
+PROJECT_ID      = os.environ.get("GOOGLE_CLOUD_PROJECT")
+LOCATION        = os.environ.get("VERTEX_LOCATION", "us-central1")
+MODEL_NAME      = os.environ.get("VERTEX_MODEL", "gemini-1.5-flash-002")
+MAX_CONCURRENCY = int(os.environ.get("VERTEX_MAX_CONCURRENCY", "4"))
+# count_tokens on startup opens the gRPC channel before the first real request
+WARMUP          = os.environ.get("VERTEX_WARMUP", "true").lower() in ("1", "true", "yes", "on")
+
+class VertexModel:
+    def __init__(self, max_concurrency: int = MAX_CONCURRENCY):
+        self._model: Optional[GenerativeModel] = None
+        self._lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def get(self) -> GenerativeModel:
+        if self._model is not None:
+            return self._model
+        async with self._lock:
+            if self._model is None:
+                t0 = time.perf_counter()
+                self._model = await asyncio.to_thread(self._build)
+                metrics.observe("vertex.cold_start", (time.perf_counter() - t0) * 1000)
+        return self._model
+
+    def _build(self) -> GenerativeModel:
+        vertex_init(project=PROJECT_ID, location=LOCATION)
+        model = GenerativeModel(MODEL_NAME)
+        if WARMUP:
+            try:
+                model.count_tokens("ping")
+            except Exception as e:
+                print(f"[vertex] warm-up call failed: {e}", flush=True)
+        return model
+
+    async def warm(self) -> None:
+        """Background pre-initialisation from the lifespan; failures fall back to lazy init."""
+        try:
+            await self.get()
+        except Exception as e:
+            print(f"[vertex] pre-initialisation failed: {e}", flush=True)
+
+    @asynccontextmanager
+    async def slot(self):
+        t0 = time.perf_counter()
+        async with self._slots:
+            metrics.observe("vertex.queue_wait", (time.perf_counter() - t0) * 1000)
+            yield
+
+def get_vertex(request: Request) -> VertexModel:
+    vertex = getattr(request.app.state, "vertex", None)
+    if vertex is None:  # app started without the lifespan (tests, scripts)
+        vertex = request.app.state.vertex = VertexModel()
+    return vertex
@@ -0,0 +1,73 @@
+"""
+Microbenchmark for the connector's payload decoding.
+
+Compares the old per-message path (bytes → str → json.loads + isinstance)
+with TelemetryDecoder on a single thread, i.e. messages/s per core:
+
+    python bench/decode_bench.py [--n 200000]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fivetran_connector"))
+
+from decoding import JSON_BACKEND, TelemetryDecoder  # noqa: E402
+
+MACHINES = ("mx-01", "kn-02", "ct-03", "ov-04", "cl-05", "pk-06")
+
+
+def sample_messages(n: int):
+    msgs = []
+    for i in range(n):
+        mid = MACHINES[i % len(MACHINES)]
+        ts = 1_700_000_000 + i / len(MACHINES)
+        payload = {
+            "pk": f"{mid}:{int(ts * 1000)}", "ts": ts, "machine_id": mid,
+            "name": "Mixer 3000", "type": "Mixer",
+            "temp_c": round(random.uniform(26, 32), 4), "speed_rpm": round(random.uniform(800, 1200), 4),
+            "vibration_g": round(random.uniform(0.02, 0.05), 4), "motor_current_a": round(random.uniform(4, 8), 4),
+            "bowl_load_kg": round(random.uniform(50, 120), 4), "power_w": 1200.5,
+            "co2_kg_per_min": 0.00048, "noise_db": 80, "ambient_temp_c": 26,
+            "scrap_rate_pct": 0.42, "batch_id": "B-20251017-10",
+        }
+        msgs.append((f"factory/{mid}/telemetry", json.dumps(payload).encode()))
+    return msgs
+
+
+def legacy(topic, raw):
+    payload = json.loads(raw.decode("utf-8"))
+    if not isinstance(payload, dict):
+        return None
+    ts = payload.get("ts")
+    if isinstance(ts, (int, float)):
+        float(ts)
+    return payload
+
+
+def run(label, fn, msgs):
+    start = time.perf_counter()
+    for topic, raw in msgs:
+        fn(topic, raw)
+    elapsed = time.perf_counter() - start
+    rate = len(msgs) / elapsed
+    print(f"{label:<28} {rate:>12,.0f} msg/s/core")
+    return rate
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200_000)
+    args = ap.parse_args()
+
+    msgs = sample_messages(args.n)
+    before = run("before (json.loads+decode)", legacy, msgs)
+    after = run(f"after ({JSON_BACKEND}, cached)", TelemetryDecoder().decode, msgs)
+    print(f"speedup x{after / before:.2f}")
+
+
+if __name__ == "__main__":
+    main()
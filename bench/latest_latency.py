@@ -0,0 +1,59 @@
+"""
+Latency probe for GET /api/machines/latest against a running server.
+
+    python bench/latest_latency.py --url http://localhost:8000 --n 200 --concurrency 8
+
+Prints p50/p90/p99 and throughput so runs before and after a change can be
+compared on the same machine.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+def pct(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+async def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", default="http://localhost:8000")
+    ap.add_argument("--path", default="/api/machines/latest?minutes=120")
+    ap.add_argument("--n", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--warmup", type=int, default=3)
+    args = ap.parse_args()
+
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+        for _ in range(args.warmup):
+            await client.get(args.path)
+
+        async def one():
+            nonlocal errors
+            async with sem:
+                t0 = time.perf_counter()
+                r = await client.get(args.path)
+                latencies.append((time.perf_counter() - t0) * 1000)
+                if r.status_code != 200 or "error" in r.json():
+                    errors += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.n)))
+        wall = time.perf_counter() - t0
+
+    print(f"{args.path}  n={args.n} concurrency={args.concurrency} errors={errors}")
+    print(f"p50={pct(latencies, 50):.1f}ms  p90={pct(latencies, 90):.1f}ms  "
+          f"p99={pct(latencies, 99):.1f}ms  mean={statistics.mean(latencies):.1f}ms  "
+          f"rps={args.n / wall:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+import time
+from typing import Optional
+
+
+class AdaptiveWindow:
+    """
+    Picks how long update() may wait for a batch to fill.
+
+    Keeps an EWMA of the observed arrival rate (spool offsets per second across
+    syncs) and sizes the window so that `batch_max` messages would arrive in
+    it, clamped to [min_s, max_s]. Busy lines get short windows (fresher data,
+    full batches); quiet lines wait up to max_s to avoid tiny writes.
+    """
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.rate: Optional[float] = None  # messages / second
+        self._last_head: Optional[int] = None
+        self._last_at: Optional[float] = None
+
+    def observe(self, head: int, now: Optional[float] = None):
+        """Feed the spool head offset; the delta since the last call updates the rate."""
+        now = time.monotonic() if now is None else now
+        if self._last_head is not None and now > self._last_at:
+            sample = max(0, head - self._last_head) / (now - self._last_at)
+            self.rate = sample if self.rate is None else (
+                self.alpha * sample + (1 - self.alpha) * self.rate
+            )
+        self._last_head, self._last_at = head, now
+
+    def window(self, batch_max: int, min_s: float, max_s: float) -> float:
+        min_s = min(min_s, max_s)
+        if not self.rate:
+            return max_s
+        return max(min_s, min(max_s, batch_max / self.rate))
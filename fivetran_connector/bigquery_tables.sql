@@ -0,0 +1,148 @@
+-- Pre-create the destination tables before the connector's first sync so
+-- BigQuery partitions them by event day and clusters them by machine.
+-- Fivetran keeps an existing table's partitioning and clustering.
+-- Column names follow Fivetran's naming rules (co2_kg_per_min → co_2_kg_per_min).
+--
+--   bq query --use_legacy_sql=false < fivetran_connector/bigquery_tables.sql
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry` (
+  pk               STRING NOT NULL,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  machine_id       STRING,
+  name             STRING,
+  type             STRING,
+  power_w          FLOAT64,
+  co_2_kg_per_min  FLOAT64,
+  noise_db         FLOAT64,
+  ambient_temp_c   FLOAT64,
+  scrap_rate_pct   FLOAT64,
+  batch_id         STRING,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+-- Per-machine-type sensor tables (FANOUT_BY_TYPE=true), keyed by the same pk
+-- as the core table above.
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_mixer` (
+  pk               STRING NOT NULL,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  machine_id       STRING,
+  temp_c           FLOAT64,
+  speed_rpm        FLOAT64,
+  vibration_g      FLOAT64,
+  motor_current_a  FLOAT64,
+  bowl_load_kg     FLOAT64,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_kneader` (
+  pk               STRING NOT NULL,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  machine_id       STRING,
+  dough_temp_c     FLOAT64,
+  torque_nm        FLOAT64,
+  motor_current_a  FLOAT64,
+  speed_rpm        FLOAT64,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_cutter` (
+  pk                STRING NOT NULL,
+  ts                FLOAT64,
+  event_time        TIMESTAMP,
+  machine_id        STRING,
+  blade_rpm         FLOAT64,
+  blade_vibration_g FLOAT64,
+  air_pressure_bar  FLOAT64,
+  piece_length_mm   FLOAT64,
+  _fivetran_synced  TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_oven` (
+  pk               STRING NOT NULL,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  machine_id       STRING,
+  zone_1_temp_c    FLOAT64,
+  zone_2_temp_c    FLOAT64,
+  humidity_pct     FLOAT64,
+  belt_speed_mpm   FLOAT64,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_cooler` (
+  pk               STRING NOT NULL,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  machine_id       STRING,
+  air_temp_c       FLOAT64,
+  airflow_cfm      FLOAT64,
+  humidity_pct     FLOAT64,
+  belt_speed_mpm   FLOAT64,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_packer` (
+  pk                 STRING NOT NULL,
+  ts                 FLOAT64,
+  event_time         TIMESTAMP,
+  machine_id         STRING,
+  seal_temp_c        FLOAT64,
+  seal_pressure_bar  FLOAT64,
+  conveyor_speed_mpm FLOAT64,
+  reject_rate_pct    FLOAT64,
+  _fivetran_synced   TIMESTAMP
+)
+PARTITION BY DATE(event_time)
+CLUSTER BY machine_id;
+
+-- Per-minute rollups (ROLLUP_1M=true). The <field>_min/_max/_mean/_last
+-- columns are added by Fivetran as new fields appear.
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_1m` (
+  pk               STRING NOT NULL,
+  machine_id       STRING,
+  name             STRING,
+  type             STRING,
+  minute_start     TIMESTAMP,
+  count            INT64,
+  kwh              FLOAT64,
+  co_2_kg          FLOAT64,
+  _fivetran_synced TIMESTAMP
+)
+PARTITION BY DATE(minute_start)
+CLUSTER BY machine_id;
+
+-- Newest core reading per machine (LATEST_TABLE=true). The connector upserts
+-- it keyed by machine_id, so it only ever holds one row per machine and the
+-- API reads it with a point lookup instead of ranking the telemetry window.
+CREATE TABLE IF NOT EXISTS `cookie_factory_mqtt.telemetry_latest` (
+  machine_id       STRING NOT NULL,
+  pk               STRING,
+  ts               FLOAT64,
+  event_time       TIMESTAMP,
+  name             STRING,
+  type             STRING,
+  power_w          FLOAT64,
+  co_2_kg_per_min  FLOAT64,
+  noise_db         FLOAT64,
+  ambient_temp_c   FLOAT64,
+  scrap_rate_pct   FLOAT64,
+  batch_id         STRING,
+  _fivetran_synced TIMESTAMP
+)
+CLUSTER BY machine_id;
@@ -0,0 +1,50 @@
+import time
+from typing import Any, Dict
+
+from fivetran_connector_sdk import Operations as op
+
+
+class BulkWriter:
+    """
+    Buffered write stage in front of op.upsert.
+
+    Records are grouped by destination table and coalesced on their primary
+    key, keeping the one with the latest `ts`, so a chunk never writes the
+    same row twice. flush() emits everything buffered and tracks how many
+    records were written and how long that took, so each sync can report
+    upsert throughput.
+    """
+
+    def __init__(self):
+        self._tables: Dict[str, Dict[Any, Dict[str, Any]]] = {}
+        self.written = 0
+        self.per_table: Dict[str, int] = {}
+        self.coalesced = 0
+        self.elapsed = 0.0
+
+    def add(self, table: str, record: Dict[str, Any], key: str = "pk"):
+        rows = self._tables.setdefault(table, {})
+        pk = record.get(key)
+        prev = rows.get(pk)
+        if prev is not None:
+            self.coalesced += 1
+            if (prev.get("ts") or 0) > (record.get("ts") or 0):
+                return
+        rows[pk] = record
+
+    def flush(self) -> int:
+        """Upsert everything buffered; returns the number of records written."""
+        start = time.monotonic()
+        n = 0
+        for table, rows in self._tables.items():
+            for record in rows.values():
+                op.upsert(table=table, data=record)
+            n += len(rows)
+            self.per_table[table] = self.per_table.get(table, 0) + len(rows)
+        self._tables.clear()
+        self.written += n
+        self.elapsed += time.monotonic() - start
+        return n
+
+    def rate(self) -> float:
+        return self.written / self.elapsed if self.elapsed > 0 else 0.0
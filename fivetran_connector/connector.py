@@ -1,37 +1,246 @@
-import json
+import atexit
 import os
 import time
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
 import paho.mqtt.client as mqtt
 from fivetran_connector_sdk import Connector
 from fivetran_connector_sdk import Logging as log
 from fivetran_connector_sdk import Operations as op
 
+from batching import AdaptiveWindow
+from bulk import BulkWriter
+from decoding import TelemetryDecoder
+from dedupe import RecentKeys
+from rollup import MinuteRollup
+from spool import Spool
+
 ENV_MQTT_HOST = os.getenv("MQTT_HOST", "127.0.0.1")
 ENV_MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 ENV_MQTT_USER = os.getenv("MQTT_USER", "")
 ENV_MQTT_PASS = os.getenv("MQTT_PASS", "")
-ENV_TOPIC     = os.getenv("TOPIC", "factory/+/telemetry")
+ENV_TOPIC     = os.getenv("TOPIC", "factory/+/telemetry/#")  # also matches .../telemetry/msgpack
 ENV_QOS       = int(os.getenv("QOS", "1"))
 ENV_BATCH_S   = float(os.getenv("BATCH_SECONDS", "10"))
 ENV_BATCH_MAX = int(os.getenv("BATCH_MAX", "1000"))
+ENV_BATCH_MIN_S = float(os.getenv("BATCH_MIN_SECONDS", "0.5"))
+ENV_BATCH_BYTES = int(os.getenv("BATCH_BYTES", str(4 * 1024 * 1024)))
+ENV_UPSERT_CHUNK = int(os.getenv("UPSERT_CHUNK", "500"))  # spool rows per checkpoint
 ENV_TABLE     = os.getenv("TABLE_NAME", "telemetry")
+ENV_FANOUT    = os.getenv("FANOUT_BY_TYPE", "true").lower() in ("1", "true", "yes", "on")
+ENV_ROLLUP    = os.getenv("ROLLUP_1M", "true").lower() in ("1", "true", "yes", "on")
+ENV_LATEST    = os.getenv("LATEST_TABLE", "true").lower() in ("1", "true", "yes", "on")
+ENV_CLIENT_ID = os.getenv("CLIENT_ID", "fivetran-cookie-connector")  # stable id → durable session
+ENV_SPOOL     = os.getenv("SPOOL_PATH", "mqtt_spool.sqlite3")
+ENV_SPOOL_MAX = int(os.getenv("SPOOL_MAX_ROWS", "1000000"))
+ENV_DEDUPE_MAX = int(os.getenv("DEDUPE_MAX", "100000"))
+ENV_LATE_GRACE_S = float(os.getenv("LATE_GRACE_SECONDS", "300"))  # accept this far behind a watermark
+
+# Destination schema. `event_time` is a real TIMESTAMP derived from `ts` so
+# BigQuery can partition on it; see bigquery_tables.sql for the partitioned,
+# clustered table definitions.
+#
+# With FANOUT_BY_TYPE on (default) the core table only holds the metrics every
+# machine reports, and each machine type's sensors go to a narrow
+# `<table>_<type>` table keyed by the same pk.
+TELEMETRY_COLUMNS = {
+    "pk": "STRING",
+    "ts": "DOUBLE",
+    "event_time": "UTC_DATETIME",
+    "machine_id": "STRING",
+    "name": "STRING",
+    "type": "STRING",
+    "power_w": "DOUBLE",
+    "co2_kg_per_min": "DOUBLE",
+    "noise_db": "DOUBLE",
+    "ambient_temp_c": "DOUBLE",
+    "scrap_rate_pct": "DOUBLE",
+    "batch_id": "STRING",
+}
+
+
+KEY_COLUMNS = ("pk", "ts", "event_time", "machine_id")
+
+# Per-minute rollup table (<table>_1m); the <field>_min/_max/_mean/_last
+# columns for each numeric field are inferred.
+ROLLUP_COLUMNS = {
+    "pk": "STRING",
+    "machine_id": "STRING",
+    "name": "STRING",
+    "type": "STRING",
+    "minute_start": "UTC_DATETIME",
+    "count": "LONG",
+    "kwh": "DOUBLE",
+    "co2_kg": "DOUBLE",
+}
+
+# <table>_latest holds one row per machine (primary key machine_id) with the
+# core columns of its newest reading, so readers can do a point lookup instead
+# of ranking the whole window.
+LATEST_KEY = "machine_id"
+
+# Sensor sets per machine type (vm/startup.sh machines.json). Types not listed
+# here still get their own table, with inferred column types.
+SENSOR_COLUMNS = {
+    "mixer":   ("temp_c", "speed_rpm", "vibration_g", "motor_current_a", "bowl_load_kg"),
+    "kneader": ("dough_temp_c", "torque_nm", "motor_current_a", "speed_rpm"),
+    "cutter":  ("blade_rpm", "blade_vibration_g", "air_pressure_bar", "piece_length_mm"),
+    "oven":    ("zone1_temp_c", "zone2_temp_c", "humidity_pct", "belt_speed_mpm"),
+    "cooler":  ("air_temp_c", "airflow_cfm", "humidity_pct", "belt_speed_mpm"),
+    "packer":  ("seal_temp_c", "seal_pressure_bar", "conveyor_speed_mpm", "reject_rate_pct"),
+}
+
+
+def _get_cfg(configuration: Dict[str, Any], name: str, cast, default):
+    """Prefer configuration[name], then env var, else default; always cast safely."""
+    v = configuration.get(name, None)
+    if v is None:
+        v = os.getenv(name, None)
+    if v is None or (isinstance(v, str) and v.strip() == ""):
+        return default
+    try:
+        return cast(v)
+    except Exception:
+        return default
+
+
+def _as_bool(v) -> bool:
+    return v if isinstance(v, bool) else str(v).strip().lower() in ("1", "true", "yes", "on")
+
+
+def _event_time(ts: float) -> str:
+    """Epoch seconds → ISO-8601 UTC with millisecond precision."""
+    ms = int(round(ts * 1000))
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ms // 1000)) + f".{ms % 1000:03d}Z"
+
+
+def _type_slug(machine_type: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in machine_type.strip().lower())
+
+
+def _route(table: str, record: Dict[str, Any], fanout: bool) -> List[Tuple[str, Dict[str, Any]]]:
+    """Split one telemetry record into (table, row) pairs for the destination."""
+    mtype = record.get("type")
+    if not fanout or not isinstance(mtype, str) or not mtype:
+        return [(table, record)]
+    core: Dict[str, Any] = {}
+    sensors: Dict[str, Any] = {k: record[k] for k in KEY_COLUMNS if k in record}
+    for k, v in record.items():
+        if k in TELEMETRY_COLUMNS:
+            core[k] = v
+        else:
+            sensors[k] = v
+    if len(sensors) == len(KEY_COLUMNS):
+        return [(table, core)]
+    return [(table, core), (f"{table}_{_type_slug(mtype)}", sensors)]
+
+
+def schema(configuration: Dict[str, Any]) -> List[Dict[str, Any]]:
+    table = _get_cfg(configuration, "TABLE_NAME", str, ENV_TABLE)
+    tables = [{"table": table, "primary_key": ["pk"], "columns": dict(TELEMETRY_COLUMNS)}]
+    if _get_cfg(configuration, "FANOUT_BY_TYPE", _as_bool, ENV_FANOUT):
+        for mtype, sensors in SENSOR_COLUMNS.items():
+            columns = {k: TELEMETRY_COLUMNS[k] for k in KEY_COLUMNS}
+            columns.update({s: "DOUBLE" for s in sensors})
+            tables.append({"table": f"{table}_{mtype}", "primary_key": ["pk"], "columns": columns})
+    if _get_cfg(configuration, "ROLLUP_1M", _as_bool, ENV_ROLLUP):
+        tables.append({"table": f"{table}_1m", "primary_key": ["pk"], "columns": dict(ROLLUP_COLUMNS)})
+    if _get_cfg(configuration, "LATEST_TABLE", _as_bool, ENV_LATEST):
+        tables.append({"table": f"{table}_latest", "primary_key": [LATEST_KEY],
+                       "columns": dict(TELEMETRY_COLUMNS)})
+    return tables
+
+
+class _Consumer:
+    """
+    Long-lived MQTT subscriber shared by every update() call in this process.
+
+    The client uses a stable client id with clean_session=False, so the broker
+    keeps our subscription and queues QoS>=1 messages while we are offline;
+    between syncs the network loop keeps appending raw payloads to the on-disk
+    spool and update() only drains what has already arrived.
+    """
+
+    def __init__(self, host: str, port: int, user: str, password: str,
+                 topic: str, qos: int, client_id: str, spool_path: str, spool_max: int,
+                 dedupe_max: int):
+        self.key = (host, port, user, password, topic, qos, client_id, spool_path, spool_max,
+                    dedupe_max)
+        self.topic = topic
+        self.qos = qos
+        self.spool = Spool(spool_path, max_rows=spool_max)
+        self.window = AdaptiveWindow()
+        self.recent = RecentKeys(dedupe_max)
+        self.decoder = TelemetryDecoder()
+
+        self.client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2,
+            client_id=client_id,
+            clean_session=False,
+        )
+        if user:
+            self.client.username_pw_set(user, password)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect_async(host, port, keepalive=30)
+        self.client.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            present = getattr(flags, "session_present", None)
+            log.fine(f"Connected to MQTT broker (session_present={present}). Subscribing…")
+            client.subscribe(self.topic, qos=self.qos)
+        else:
+            log.warning(f"MQTT connect failed rc={rc}")
+
+    def _on_message(self, client, userdata, msg):
+        # Keep the network thread cheap: persist raw bytes, decode at upsert time.
+        try:
+            self.spool.append(msg.topic, msg.payload)
+        except Exception as e:
+            log.warning(f"Spool append failed on {msg.topic}: {e}; dropping")
+
+    def close(self):
+        with _suppress():
+            self.client.loop_stop()
+        with _suppress():
+            self.client.disconnect()
+        with _suppress():
+            self.spool.close()
+
+
+_consumer: Optional[_Consumer] = None
+
+
+def _get_consumer(*args) -> _Consumer:
+    """Reuse the running consumer unless the broker settings changed."""
+    global _consumer
+    if _consumer is not None and _consumer.key == args:
+        return _consumer
+    if _consumer is not None:
+        _consumer.close()
+    _consumer = _Consumer(*args)
+    return _consumer
+
+
+def _topic_machine_id(topic: str) -> str:
+    """factory/<machine_id>/telemetry → <machine_id> (payloads normally carry it too)."""
+    parts = topic.split("/")
+    return parts[1] if len(parts) > 1 else topic
+
+
+@atexit.register
+def _close_consumer():
+    if _consumer is not None:
+        _consumer.close()
+
 
 def update(configuration: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
-    """Collect a short MQTT batch and upsert to destination via Fivetran."""
+    """Drain messages buffered by the persistent MQTT consumer and upsert them via Fivetran."""
 
     def get_cfg(name: str, cast, default):
-        """Prefer configuration[name], then env var, else default; always cast safely."""
-        v = configuration.get(name, None)
-        if v is None:
-            v = os.getenv(name, None)
-        if v is None or (isinstance(v, str) and v.strip() == ""):
-            return default
-        try:
-            return cast(v)
-        except Exception:
-            return default
+        return _get_cfg(configuration, name, cast, default)
 
     mqtt_host: str = get_cfg("MQTT_HOST", str, ENV_MQTT_HOST)
     mqtt_port: int = get_cfg("MQTT_PORT", int, ENV_MQTT_PORT)
@@ -41,75 +250,142 @@ def update(configuration: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, An
     qos:       int = get_cfg("QOS", int, ENV_QOS)
     batch_s: float = get_cfg("BATCH_SECONDS", float, ENV_BATCH_S)
     batch_max: int = get_cfg("BATCH_MAX", int, ENV_BATCH_MAX)
+    batch_min_s: float = get_cfg("BATCH_MIN_SECONDS", float, ENV_BATCH_MIN_S)
+    batch_bytes: int = get_cfg("BATCH_BYTES", int, ENV_BATCH_BYTES)
+    chunk: int = max(1, get_cfg("UPSERT_CHUNK", int, ENV_UPSERT_CHUNK))
     table:    str  = get_cfg("TABLE_NAME", str, ENV_TABLE)
+    fanout:  bool  = get_cfg("FANOUT_BY_TYPE", _as_bool, ENV_FANOUT)
+    rollup_on: bool = get_cfg("ROLLUP_1M", _as_bool, ENV_ROLLUP)
+    latest_on: bool = get_cfg("LATEST_TABLE", _as_bool, ENV_LATEST)
+    client_id: str = get_cfg("CLIENT_ID", str, ENV_CLIENT_ID)
+    spool_path: str = get_cfg("SPOOL_PATH", str, ENV_SPOOL)
+    spool_max: int = get_cfg("SPOOL_MAX_ROWS", int, ENV_SPOOL_MAX)
+    dedupe_max: int = get_cfg("DEDUPE_MAX", int, ENV_DEDUPE_MAX)
+    late_grace_s: float = get_cfg("LATE_GRACE_SECONDS", float, ENV_LATE_GRACE_S)
 
     log.fine(f"MQTT batch start host={mqtt_host} port={mqtt_port} topic={topic} qos={qos}")
 
-    collected: List[Dict[str, Any]] = []
     last_ts_seen: float = float(state.get("last_ts", 0.0))  # always a float
-
-    def on_connect(client, userdata, flags, rc, *args):
-        if rc == 0:
-            log.fine("Connected to MQTT broker. Subscribing…")
-            client.subscribe(topic, qos=qos)
-        else:
-            log.warning(f"MQTT connect failed rc={rc}")
-
-    def on_message(client, userdata, msg):
-        try:
-            payload = json.loads(msg.payload.decode("utf-8"))
-            if not isinstance(payload, dict):
-                return
-            ts = payload.get("ts")
-            if isinstance(ts, (int, float)) and float(ts) <= last_ts_seen:
-                return
-            collected.append(payload)
-        except Exception as e:
-            log.warning(f"Bad payload on {msg.topic}: {e}; skipping")
-
-    client = mqtt.Client()
-    if mqtt_user:
-        client.username_pw_set(mqtt_user, mqtt_pass)
-    client.on_connect = on_connect
-    client.on_message = on_message
+    # Per-machine watermarks so one skewed clock can't starve the others;
+    # machines we have not seen yet fall back to the legacy global last_ts.
+    first_run = "watermarks" not in state
+    watermarks: Dict[str, float] = {k: float(v) for k, v in state.get("watermarks", {}).items()}
+    offset: int = int(state.get("spool_offset", 0))
+    consumer: Optional[_Consumer] = None
 
     try:
-        client.connect(mqtt_host, mqtt_port, keepalive=30)
-        client.loop_start()
+        consumer = _get_consumer(mqtt_host, mqtt_port, mqtt_user, mqtt_pass, topic, qos,
+                                 client_id, spool_path, spool_max, dedupe_max)
+        spool = consumer.spool
+        if offset > spool.head():
+            log.warning(f"Spool at {spool_path} is behind state offset {offset}; restarting from 0")
+            offset = 0
 
+        # A backlog is drained right away. With nothing pending, wake as soon
+        # as the batch is full (rows or bytes), otherwise after at most the
+        # adaptive window sized from the observed arrival rate.
+        head = spool.head()
+        consumer.window.observe(head)
+        window = 0.0 if head > offset else consumer.window.window(batch_max, batch_min_s, batch_s)
         start = time.monotonic()
-        while (time.monotonic() - start) < batch_s and len(collected) < batch_max:
-            time.sleep(0.1)
+        pending, pending_bytes = spool.wait(offset, batch_max, batch_bytes, window)
+        waited = time.monotonic() - start
+        consumer.window.observe(spool.head())
 
     except Exception as e:
         log.warning(f"MQTT operation failed: {e}")
+        op.checkpoint(state)
+        return state
 
-    finally:
-        with _suppress():
-            client.loop_stop()
-        with _suppress():
-            client.disconnect()
-
-    if collected:
-        log.fine(f"Collected {len(collected)} messages → writing to '{table}'")
-        max_ts = last_ts_seen
-        for record in collected:
-            op.upsert(table=table, data=record)
-            ts = record.get("ts")
-            if isinstance(ts, (int, float)):
-                fts = float(ts)
-                if fts > max_ts:
-                    max_ts = fts
-        state["last_ts"] = float(max_ts)
-
-    op.checkpoint(state)
+    # Drain up to batch_max spooled rows in chunks; each chunk is coalesced,
+    # upserted and checkpointed so a failure only replays the current chunk.
+    writer = BulkWriter()
+    rollup = MinuteRollup(state.get("rollup")) if rollup_on else None
+    read = dropped_late = dropped_dupes = 0
+    while read < batch_max:
+        rows = spool.read(offset, min(chunk, batch_max - read))
+        if not rows:
+            break
+        read += len(rows)
+
+        new_marks: Dict[str, float] = dict(watermarks)
+        pks: Dict[Any, None] = {}  # accepted this chunk, in order (QoS 1 can redeliver within it)
+        for _, msg_topic, raw in rows:
+            # A record that can't be decoded or converted is skipped, never
+            # retried: it would otherwise block every sync at this offset.
+            try:
+                payload = consumer.decoder.decode(msg_topic, raw)
+                machine_id = str(payload.get("machine_id") or _topic_machine_id(msg_topic))
+                ts = float(payload["ts"])
+                pk = payload["pk"]
+                if pk in consumer.recent or pk in pks:
+                    dropped_dupes += 1
+                    continue
+                # The watermark is only a coarse floor: a late row we never wrote
+                # is kept within LATE_GRACE_SECONDS, exact repeats are caught above.
+                mark = watermarks.get(machine_id, last_ts_seen if first_run else 0.0)
+                if ts <= mark - late_grace_s:
+                    dropped_late += 1
+                    continue
+                payload["event_time"] = _event_time(ts)
+                if rollup is not None:
+                    rollup.add(payload)
+            except (ValueError, TypeError, OverflowError, OSError) as e:  # DecodeError is a ValueError
+                log.warning(f"Bad payload on {msg_topic}: {e}; skipping")
+                continue
+            for dest, row in _route(table, payload, fanout):
+                writer.add(dest, row)
+            if latest_on and ts > new_marks.get(machine_id, mark):
+                # Newer than any row already sent for this machine; the
+                # writer keeps the newest per machine within the chunk.
+                writer.add(f"{table}_latest",
+                           {k: payload[k] for k in TELEMETRY_COLUMNS if k in payload},
+                           key=LATEST_KEY)
+            pks[pk] = None
+            if ts > new_marks.get(machine_id, 0.0):
+                new_marks[machine_id] = ts
+
+        if rollup is not None:
+            for row in rollup.rows(_event_time):
+                writer.add(f"{table}_1m", row)
+            state["rollup"] = rollup.to_state()
+        writer.flush()
+        offset = int(rows[-1][0])
+        watermarks = new_marks
+        state["watermarks"] = watermarks
+        state["last_ts"] = max([last_ts_seen, *watermarks.values()])
+        state["spool_offset"] = offset
+        op.checkpoint(state)
+        # Only forget spooled rows once Fivetran has durably checkpointed them.
+        spool.ack(offset)
+        for pk in pks:
+            consumer.recent.add(pk)
+
+    if read == 0:
+        op.checkpoint(state)
+
+    rate = consumer.window.rate
+    log.info(
+        f"Batch window={window:.2f}s waited={waited:.2f}s "
+        f"rate={(rate or 0.0):.1f}/s pending={pending} bytes={pending_bytes} "
+        f"fill={read / max(1, batch_max):.0%}"
+    )
+    if dropped_late or dropped_dupes or writer.coalesced:
+        log.fine(f"Dropped {dropped_late} late, {dropped_dupes} duplicate and "
+                 f"coalesced {writer.coalesced} same-pk messages")
+    if consumer.decoder.schema_changes:
+        log.fine(f"Payload key sets changed {consumer.decoder.schema_changes} times since start")
+    if writer.written:
+        per_table = ", ".join(f"{t}={n}" for t, n in sorted(writer.per_table.items()))
+        log.info(f"Upserted {writer.written} records ({per_table}) in {writer.elapsed:.3f}s "
+                 f"({writer.rate():.0f} records/s)")
     return state
 
 class _suppress:
     def __enter__(self): return self
     def __exit__(self, *args): return True
 
-connector = Connector(update=update)
+connector = Connector(update=update, schema=schema)
 
 if __name__ == "__main__":
     connector.debug()
@@ -0,0 +1,104 @@
+import json
+from typing import Any, Callable, Dict, FrozenSet, Optional
+
+try:  # optional fast path; json.loads also accepts bytes, just slower
+    import orjson
+
+    _loads: Callable[[bytes], Any] = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:  # pragma: no cover - depends on the runtime image
+    _loads = json.loads
+    JSON_BACKEND = "json"
+
+try:  # optional binary wire format (topic suffix /msgpack)
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+# Fields the rest of the pipeline relies on, with the types it expects.
+REQUIRED_FIELDS = {"pk": (str,), "ts": (int, float), "machine_id": (str,)}
+
+# Binary schema v1: one version byte, then a msgpack array holding these core
+# fields positionally followed by a {sensor: value} map. Keep in sync with
+# encode_v1() in vm/startup.sh (telemetry.py).
+BINARY_V1 = 1
+CORE_FIELDS_V1 = (
+    "pk", "ts", "machine_id", "name", "type", "power_w", "co2_kg_per_min",
+    "noise_db", "ambient_temp_c", "scrap_rate_pct", "batch_id",
+)
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class JsonDecoder:
+    """Parse JSON straight from the MQTT payload bytes (no decode-to-str copy)."""
+
+    name = "json"
+
+    def decode(self, payload: bytes) -> Any:
+        return _loads(payload)
+
+
+class MsgpackDecoder:
+    """Versioned compact binary telemetry (see CORE_FIELDS_V1)."""
+
+    name = "msgpack"
+
+    def decode(self, payload: bytes) -> Any:
+        if not payload:
+            raise ValueError("empty payload")
+        version = payload[0]
+        if version != BINARY_V1:
+            raise ValueError(f"unsupported schema version {version}")
+        values = msgpack.unpackb(memoryview(payload)[1:])
+        if not isinstance(values, list) or len(values) != len(CORE_FIELDS_V1) + 1:
+            raise ValueError("bad v1 layout")
+        record = dict(zip(CORE_FIELDS_V1, values))
+        record.update(values[-1])
+        return record
+
+
+class TelemetryDecoder:
+    """
+    Pluggable payload decoder with a per-topic schema cache.
+
+    The wire decoder is picked from the last topic level (e.g. .../telemetry/msgpack);
+    anything else uses the default JSON decoder. Every message has its
+    required fields type-checked (cheap); the key set last seen on each topic
+    (factory/<machine_id>/telemetry) is cached only to count schema drift.
+    """
+
+    def __init__(self, default: Optional[Any] = None):
+        self.default = default or JsonDecoder()
+        self._by_suffix: Dict[str, Any] = {}
+        self._schemas: Dict[str, FrozenSet[str]] = {}
+        self.schema_changes = 0  # messages whose key set differed from their topic's last one
+        if msgpack is not None:
+            self.register("msgpack", MsgpackDecoder())
+
+    def register(self, suffix: str, decoder: Any):
+        """Route topics ending in /<suffix> to `decoder`."""
+        self._by_suffix[suffix] = decoder
+
+    def decode(self, topic: str, payload: bytes) -> Dict[str, Any]:
+        decoder = self._by_suffix.get(topic.rpartition("/")[2], self.default)
+        try:
+            record = decoder.decode(payload)
+        except Exception as e:
+            raise DecodeError(f"{decoder.name} decode failed: {e}") from e
+        if type(record) is not dict:
+            raise DecodeError(f"expected an object, got {type(record).__name__}")
+
+        for field, types in REQUIRED_FIELDS.items():
+            value = record.get(field)
+            if value is None or isinstance(value, bool) or not isinstance(value, types):
+                raise DecodeError(f"missing or invalid '{field}'")
+
+        known = self._schemas.get(topic)
+        if known is None or record.keys() != known:
+            if known is not None:
+                self.schema_changes += 1
+            self._schemas[topic] = frozenset(record)
+        return record
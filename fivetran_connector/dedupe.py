@@ -0,0 +1,30 @@
+from collections import OrderedDict
+from typing import Hashable
+
+
+class RecentKeys:
+    """
+    Bounded LRU set of recently upserted primary keys.
+
+    QoS 1 redeliveries and duplicate publishes show up with the same `pk`;
+    remembering the last `maxlen` keys lets update() drop them before they
+    reach op.upsert. Keys are added only after their chunk is checkpointed, so
+    a failed sync does not mark unwritten rows as seen. Memory stays
+    O(maxlen) no matter how long the process runs.
+    """
+
+    def __init__(self, maxlen: int = 100_000):
+        self.maxlen = maxlen
+        self._keys: "OrderedDict[Hashable, None]" = OrderedDict()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._keys
+
+    def add(self, key: Hashable):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.maxlen:
+            self._keys.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._keys)
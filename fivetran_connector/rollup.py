@@ -0,0 +1,105 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+NON_METRIC = {"ts"}
+MAX_GAP_S = 10.0  # don't integrate power/CO₂ across gaps longer than this
+
+
+class MinuteRollup:
+    """
+    Incremental per-machine, per-minute aggregates computed while ingesting.
+
+    Each (machine_id, minute) bucket tracks min/max/mean/last for every numeric
+    field, a sample count, and energy (kWh) and CO₂ (kg) integrals over the
+    time between consecutive samples. Buckets touched by a chunk are emitted as
+    rows and upserted on a deterministic pk, so a minute spanning several
+    syncs is simply rewritten with the fuller aggregate. Only each machine's
+    newest bucket is kept in connector state; watermarks stop older minutes
+    from receiving new data.
+    """
+
+    def __init__(self, saved: Optional[Dict[str, Any]] = None, max_gap_s: float = MAX_GAP_S):
+        saved = saved or {}
+        self.max_gap_s = max_gap_s
+        self._buckets: Dict[Tuple[str, int], Dict[str, Any]] = {
+            (b["machine_id"], int(b["minute"])): b for b in saved.get("buckets", [])
+        }
+        # machine_id -> [ts, power_w, co2_kg_per_min] of the newest sample
+        self._prev: Dict[str, List[float]] = dict(saved.get("prev", {}))
+        self._touched: Set[Tuple[str, int]] = set()
+
+    def add(self, record: Dict[str, Any]) -> bool:
+        """Fold one record in; returns False if its minute was already rolled off."""
+        mid = str(record["machine_id"])
+        ts = float(record["ts"])
+        minute = int(ts // 60) * 60
+        key = (mid, minute)
+        b = self._buckets.get(key)
+        if b is None:
+            if any(m == mid and start > minute for m, start in self._buckets):
+                return False
+            b = self._buckets[key] = {
+                "machine_id": mid, "minute": minute,
+                "name": record.get("name"), "type": record.get("type"),
+                "n": 0, "kwh": 0.0, "co2_kg": 0.0, "fields": {},
+            }
+        b["n"] += 1
+        for k, v in record.items():
+            if k in NON_METRIC or isinstance(v, bool) or not isinstance(v, (int, float)):
+                continue
+            f = b["fields"].get(k)
+            if f is None:
+                b["fields"][k] = [v, v, v, 1, v, ts]  # min, max, sum, n, last, last_ts
+                continue
+            if v < f[0]:
+                f[0] = v
+            if v > f[1]:
+                f[1] = v
+            f[2] += v
+            f[3] += 1
+            if ts >= f[5]:
+                f[4], f[5] = v, ts
+
+        prev = self._prev.get(mid)
+        if prev is not None and 0 < ts - prev[0] <= self.max_gap_s:
+            dt = ts - prev[0]
+            b["kwh"] += prev[1] * dt / 3_600_000.0
+            b["co2_kg"] += prev[2] * dt / 60.0
+        if prev is None or ts > prev[0]:
+            self._prev[mid] = [
+                ts, float(record.get("power_w") or 0.0), float(record.get("co2_kg_per_min") or 0.0)
+            ]
+        self._touched.add(key)
+        return True
+
+    def rows(self, event_time) -> List[Dict[str, Any]]:
+        """Rows for every bucket touched since the last call; `event_time` formats epoch seconds."""
+        out = []
+        for key in sorted(self._touched):
+            b = self._buckets[key]
+            row: Dict[str, Any] = {
+                "pk": f"{b['machine_id']}:{b['minute']}",
+                "machine_id": b["machine_id"],
+                "name": b["name"],
+                "type": b["type"],
+                "minute_start": event_time(b["minute"]),
+                "count": b["n"],
+                "kwh": round(b["kwh"], 9),
+                "co2_kg": round(b["co2_kg"], 9),
+            }
+            for k, (lo, hi, total, n, last, _) in b["fields"].items():
+                row[f"{k}_min"] = lo
+                row[f"{k}_max"] = hi
+                row[f"{k}_mean"] = total / n
+                row[f"{k}_last"] = last
+            out.append(row)
+        self._touched.clear()
+        return out
+
+    def to_state(self) -> Dict[str, Any]:
+        """Keep only each machine's newest bucket; older ones are final once emitted."""
+        newest: Dict[str, int] = {}
+        for mid, minute in self._buckets:
+            if minute > newest.get(mid, -1):
+                newest[mid] = minute
+        self._buckets = {k: b for k, b in self._buckets.items() if newest[k[0]] == k[1]}
+        return {"buckets": list(self._buckets.values()), "prev": self._prev}
@@ -0,0 +1,116 @@
+import sqlite3
+import threading
+import time
+from typing import List, Tuple
+
+from fivetran_connector_sdk import Logging as log
+
+
+class Spool:
+    """
+    Disk-backed, append-only write-ahead spool between MQTT receipt and upsert.
+
+    Every message is stored as raw bytes with a monotonically increasing
+    offset (SQLite AUTOINCREMENT, WAL journal). The MQTT callback only appends;
+    update() reads rows after the checkpointed offset in bulk and acks them
+    once Fivetran has checkpointed, which deletes the rows and truncates the
+    WAL so the file does not grow without bound. Appends notify a condition so
+    readers can wake as soon as a size or byte threshold is reached.
+    """
+
+    CHECKPOINT_EVERY = 10_000  # acked rows between WAL truncations
+
+    def __init__(self, path: str, max_rows: int = 1_000_000):
+        self.path = path
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            " offset INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " topic TEXT NOT NULL,"
+            " payload BLOB NOT NULL)"
+        )
+        self._head = self._scalar("SELECT seq FROM sqlite_sequence WHERE name='spool'")
+        self._tail = self._scalar("SELECT MIN(offset) - 1 FROM spool", default=self._head)
+        self._pending_bytes = self._scalar("SELECT SUM(length(payload)) FROM spool")
+        self._acked_since_truncate = 0
+
+    def _scalar(self, sql: str, params: tuple = (), default: int = 0) -> int:
+        row = self._db.execute(sql, params).fetchone()
+        return int(row[0]) if row and row[0] is not None else default
+
+    def append(self, topic: str, payload: bytes) -> int:
+        """Persist one message and return its offset."""
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO spool(topic, payload) VALUES (?, ?)", (topic, bytes(payload))
+            )
+            self._head = int(cur.lastrowid)
+            self._pending_bytes += len(payload)
+            if self._head - self._tail > self.max_rows:
+                self._evict_locked()
+            self._cond.notify_all()
+            return self._head
+
+    def _evict_locked(self):
+        # Keep the newest ~90% of max_rows; losing the oldest backlog beats
+        # filling the disk, and evicting in chunks keeps this off the hot path.
+        cutoff = self._head - int(self.max_rows * 0.9)
+        self._delete_through_locked(cutoff)
+        log.warning(f"Spool over {self.max_rows} rows; dropped offsets {self._tail + 1}..{cutoff}")
+        self._tail = cutoff
+
+    def _delete_through_locked(self, offset: int):
+        freed = self._scalar("SELECT SUM(length(payload)) FROM spool WHERE offset <= ?", (offset,))
+        self._db.execute("DELETE FROM spool WHERE offset <= ?", (offset,))
+        self._pending_bytes = max(0, self._pending_bytes - freed)
+
+    def head(self) -> int:
+        """Offset of the newest appended message (0 if none ever)."""
+        with self._lock:
+            return self._head
+
+    def wait(self, after: int, max_rows: int, max_bytes: int, timeout: float) -> Tuple[int, int]:
+        """
+        Block until at least `max_rows` rows or `max_bytes` bytes are pending
+        after `after`, or `timeout` seconds pass. Returns (rows, bytes) pending.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                rows = self._head - after
+                if rows >= max_rows or self._pending_bytes >= max_bytes:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return max(0, rows), self._pending_bytes
+
+    def read(self, after: int, limit: int) -> List[Tuple[int, str, bytes]]:
+        """Return up to `limit` (offset, topic, payload) rows with offset > after."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT offset, topic, payload FROM spool WHERE offset > ? ORDER BY offset LIMIT ?",
+                (after, limit),
+            ).fetchall()
+
+    def ack(self, offset: int):
+        """Drop everything up to and including `offset` (call after op.checkpoint)."""
+        with self._lock:
+            if offset <= self._tail:
+                return
+            self._delete_through_locked(offset)
+            self._acked_since_truncate += offset - self._tail
+            self._tail = offset
+            if self._acked_since_truncate >= self.CHECKPOINT_EVERY:
+                self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._acked_since_truncate = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
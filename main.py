@@ -1,5 +1,8 @@
 # FastAPI backend and Mesop mount
 
+import asyncio
+from contextlib import asynccontextmanager
+
 import mesop as me
 from fastapi import FastAPI
 from fastapi.middleware.wsgi import WSGIMiddleware
@@ -10,9 +13,46 @@ import ui.home
 from api.machines import router as machines_router
 from api.workers import generate_new_worker
 from api.ai import router as ai_router
+from api.bq import create_bqstorage_client, create_client
+from api.hotstore import create_hot_store, to_item
+from api.storage import create_storage
+from api.stream import Broadcaster
+from api.vertex import VertexModel
+from api import metrics
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One shared, pooled BigQuery client for the whole process
+    app.state.bq_client = create_client()
+    app.state.bqstorage_client = create_bqstorage_client()
+    # Optional MQTT-fed hot telemetry store (HOT_STORE_MQTT_HOST)
+    app.state.hot_store = create_hot_store()
+    # Telemetry backend for the routes (STORAGE_BACKEND=bigquery|duckdb)
+    app.state.storage = create_storage(
+        app.state.bq_client, app.state.bqstorage_client, app.state.hot_store
+    )
+    # Warm Vertex handle for /api/ai/chat, initialised in the background
+    app.state.vertex = VertexModel()
+    vertex_warmup = asyncio.create_task(app.state.vertex.warm())
+    # Shared fan-out for /api/machines/stream
+    app.state.broadcaster = Broadcaster()
+    if app.state.hot_store is not None:
+        app.state.hot_store.add_listener(lambda s: app.state.broadcaster.publish(to_item(s)))
+    try:
+        yield
+    finally:
+        vertex_warmup.cancel()
+        if app.state.hot_store is not None:
+            app.state.hot_store.stop()
+        if app.state.storage is not None:
+            app.state.storage.close()
+        if app.state.bq_client is not None:
+            app.state.bq_client.close()
+        if app.state.bqstorage_client is not None:
+            app.state.bqstorage_client.transport.close()  # gRPC channel
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # ---- Generate a Machine ----
 app.include_router(machines_router, prefix="/api/machines", tags=["machines"])
@@ -20,6 +60,11 @@ app.include_router(machines_router, prefix="/api/machines", tags=["machines"])
 # ---- AI Router ----
 app.include_router(ai_router)
 
+# ---- Cache counters + latency reservoirs ----
+@app.get("/api/metrics")
+def metrics_snapshot():
+    return metrics.snapshot()
+
 # ---- Generate a Worker ----
 @app.post("/api/workers/generate")
 def workers_generate():
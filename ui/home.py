@@ -40,6 +40,7 @@ class State:
     machines_json: str = json.dumps(_init_machines())
     workers_json: str = json.dumps([{} for _ in range(WORKER_SLOTS)])
     w_loading_json: str = json.dumps([False] * WORKER_SLOTS)
+    telemetry_as_of: str = ""  # UTC time of the last successful /latest fetch
 
 
 def _get_lists():
@@ -91,6 +92,7 @@ async def refresh_telemetry(evt: me.ClickEvent | None):
             slot["scrap_rate_pct"] = d.get("scrap_rate_pct")
 
         _set_lists(machines, workers, w_loading)
+        s.telemetry_as_of = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
         s.status = f"Updated {len(items)} machine(s) at {time.strftime('%H:%M:%S')}"
 
 
@@ -138,6 +140,8 @@ def _chat_context_snapshot():
     return {
         "machines": live[:6],  # keep small
         "workers": [w for w in workers if w][:8],
+        # lets the API answer from this snapshot instead of re-querying while it's fresh
+        "as_of": me.state(State).telemetry_as_of or None,
     }
 
 
@@ -187,6 +191,7 @@ def transform(user_input: str, history: list[mel.ChatMessage]):
         "prompt": user_input,
         "context": _chat_context_snapshot(),
         "history": _history_to_messages(history),
+        "stream": True,
     }
 
     try:
@@ -199,8 +204,39 @@ def transform(user_input: str, history: list[mel.ChatMessage]):
 
                 ctype = (resp.headers.get("content-type") or "").lower()
 
-                # Streamed text/SSE
-                if "text/event-stream" in ctype or "text/plain" in ctype:
+                # Server-sent events: `delta` chunks are yielded as they arrive
+                # (no added newlines; the model's own line breaks are kept),
+                # the final `done` event only matters if it carries an error.
+                if "text/event-stream" in ctype:
+                    event = "message"
+                    for raw in resp.iter_lines():
+                        line = raw.decode("utf-8", errors="ignore") if isinstance(raw, (bytes, bytearray)) else str(raw)
+                        if not line:
+                            event = "message"
+                            continue
+                        if line.startswith("event:"):
+                            event = line[6:].strip()
+                            continue
+                        if not line.startswith("data:"):
+                            continue
+                        data_s = line[5:].lstrip()
+                        try:
+                            data = json.loads(data_s)
+                        except Exception:
+                            yield data_s
+                            continue
+                        if event == "delta":
+                            text = data.get("text") or ""
+                            if text:
+                                yield text
+                        elif event == "done":
+                            err = (data.get("error") or "").strip()
+                            if err:
+                                yield f"\nServer error: {err[:900]}\n"
+                    return
+
+                # Streamed plain text
+                if "text/plain" in ctype:
                     for raw in resp.iter_lines():
                         if not raw:
                             continue
@@ -32,7 +32,7 @@ systemctl restart mosquitto
 # --- Telemetry publisher ---
 mkdir -p /opt/telemetry
 python3 -m venv /opt/telemetry/venv
-/opt/telemetry/venv/bin/pip install --no-input paho-mqtt
+/opt/telemetry/venv/bin/pip install --no-input paho-mqtt msgpack
 
 cat >/opt/telemetry/machines.json <<'EOF'
 [
@@ -63,6 +63,13 @@ BROKER_PASS = os.getenv("MQTT_PASS", "demo123")
 TOPIC_BASE  = os.getenv("TOPIC_BASE", "factory")
 INTERVAL_S  = float(os.getenv("INTERVAL_S", "1.0"))
 QOS         = int(os.getenv("QOS", "1"))
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "json")  # json | msgpack
+
+# Binary schema v1 (keep in sync with fivetran_connector/decoding.py):
+# version byte + msgpack [core fields..., {sensor: value}]
+BINARY_V1 = 1
+CORE_FIELDS_V1 = ("pk", "ts", "machine_id", "name", "type", "power_w", "co2_kg_per_min",
+                  "noise_db", "ambient_temp_c", "scrap_rate_pct", "batch_id")
 
 machines = json.loads(Path("/opt/telemetry/machines.json").read_text())
 
@@ -90,7 +97,20 @@ def next_snapshot(m):
             "noise_db": noise_db, "ambient_temp_c": ambient_temp_c,
             "scrap_rate_pct": scrap_rate_pct, "batch_id": batch_id}
 
+def encode_json(payload):
+    return json.dumps(payload)
+
+def encode_v1(payload):
+    import msgpack
+    core = [payload[k] for k in CORE_FIELDS_V1]
+    sensors = {k: v for k, v in payload.items() if k not in CORE_FIELDS_V1}
+    return bytes([BINARY_V1]) + msgpack.packb(core + [sensors])
+
+# The topic suffix tells subscribers which decoder to use.
+ENCODERS = {"json": ("", encode_json), "msgpack": ("/msgpack", encode_v1)}
+
 def main():
+    suffix, encode = ENCODERS[WIRE_FORMAT]
     client = mqtt.Client(client_id=f"telemetry-pub-{uuid.uuid4().hex[:8]}")
     client.username_pw_set(BROKER_USER, BROKER_PASS)
     client.connect(BROKER_HOST, BROKER_PORT, keepalive=30)
@@ -99,8 +119,8 @@ def main():
         while True:
             for m in machines:
                 payload = next_snapshot(m)
-                topic = f"{TOPIC_BASE}/{m['machine_id']}/telemetry"
-                client.publish(topic, json.dumps(payload), qos=QOS, retain=False)
+                topic = f"{TOPIC_BASE}/{m['machine_id']}/telemetry{suffix}"
+                client.publish(topic, encode(payload), qos=QOS, retain=False)
             time.sleep(INTERVAL_S)
     finally:
         client.loop_stop()
@@ -126,6 +146,7 @@ Environment=MQTT_PASS=demo123
 Environment=TOPIC_BASE=factory
 Environment=INTERVAL_S=1.0
 Environment=QOS=1
+Environment=WIRE_FORMAT=json
 ExecStart=/opt/telemetry/venv/bin/python /usr/local/bin/telemetry.py
 Restart=always
 RestartSec=2